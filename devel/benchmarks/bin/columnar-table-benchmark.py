@@ -0,0 +1,83 @@
+#!/usr/bin/env python
+#
+#    Guernsey - Library to simplify creating REST web services using Python and Twisted
+#    Copyright (C) 2016 Ingemar Nilsson
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+#
+# Compares the memory used by a table of metric records and the time
+# of filtering and sorting it, for a plain table and a columnar table
+#
+
+import guernsey.db as db
+import guernsey.web.model as gwm
+
+import optparse, os, random, resource, time
+
+class MetricModel(gwm.Model):
+    pass
+
+class MetricTable(db.ColumnarTable):
+    modelClass = MetricModel
+    columns = [("timestamp", "d"), ("value", "d"), ("host", "l"), ("name", None)]
+
+def fill(table, size):
+    random.seed(1)
+    names = ["cpu", "memory", "disk", "network"]
+    for i in xrange(size):
+        table.set(str(i), MetricModel({"timestamp": 1500000000.0 + i,
+                                       "value": random.random() * 100,
+                                       "host": i % 100,
+                                       "name": names[i % len(names)]}))
+
+def measure(tableClass, size):
+    # Runs in a child process, so that the peak memory use is that of
+    # one table only
+    before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    table = tableClass("metrics")
+    fill(table, size)
+    memory = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - before
+
+    start = time.time()
+    found = table.find("host", 42, getCopy=False)
+    findTime = time.time() - start
+
+    start = time.time()
+    top = table.findRange("value", low=99.0, reverse=True, limit=100, getCopy=False)
+    rangeTime = time.time() - start
+
+    print "%-16s %12d %12.3f %12.3f %8d %8d" % (tableClass.__name__, memory,
+                                                 findTime * 1000, rangeTime * 1000,
+                                                 len(found), len(top))
+
+def main():
+    parser = optparse.OptionParser(usage="Usage: %prog [OPTIONS]")
+    parser.add_option("-n", "--size", action="store", type="int", dest="size",
+                      help="Number of records (Default: %default)")
+    parser.set_defaults(size=500000)
+    options, args = parser.parse_args()
+
+    print "%-16s %12s %12s %12s %8s %8s" % ("table", "peak kB", "find ms", "range ms",
+                                             "found", "top")
+    for tableClass in [db.Table, MetricTable]:
+        pid = os.fork()
+        if pid == 0:
+            measure(tableClass, options.size)
+            os._exit(0)
+        os.waitpid(pid, 0)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,72 @@
+#!/usr/bin/env python
+#
+#    Guernsey - Library to simplify creating REST web services using Python and Twisted
+#    Copyright (C) 2016 Ingemar Nilsson
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+#
+# Compares saving and loading the sample database with a large issue
+# table uncompressed and with each compression codec
+#
+
+import guernsey.db as db
+import guernsey.web.rest as rest
+
+import optparse, os, shutil, tempfile, time
+
+def createIssue(i):
+    return rest.IssueModel("ERROR", "Could not handle request %d" % (i % 500),
+                           resourcePath="/things/%d" % i,
+                           callStack=["  File \"app.py\", line %d, in render" % (i % 50)])
+
+def main():
+    parser = optparse.OptionParser(usage="Usage: %prog [OPTIONS]")
+    parser.add_option("-n", "--size", action="store", type="int", dest="size",
+                      help="Number of issues (Default: %default)")
+    parser.add_option("-l", "--level", action="store", type="int", dest="level",
+                      help="Compression level (Default: %default)")
+    parser.set_defaults(size=50000, level=6)
+    options, args = parser.parse_args()
+
+    database = rest.Database()
+    for i in xrange(options.size):
+        database.issues.add(createIssue(i))
+
+    tmpDir = tempfile.mkdtemp()
+    try:
+        filename = os.path.join(tmpDir, "benchmark.db")
+        print "Saving and loading %d issues" % options.size
+        print "%-12s %12s %12s %12s %12s" % ("codec", "save ms", "load ms", "pickle kB", "JSON kB")
+        for codec in [None] + sorted(db.Compression.codecs.keys()):
+            rest.Database.compression = codec
+            rest.Database.compressionLevel = options.level
+            # Change the table, so that every save writes all of it
+            database.issues.add(createIssue(options.size))
+            start = time.time()
+            database.save(filename)
+            saveTime = time.time() - start
+            start = time.time()
+            rest.Database.load(filename)
+            loadTime = time.time() - start
+            print "%-12s %12.3f %12.3f %12d %12d" % (
+                codec or "none", saveTime * 1000, loadTime * 1000,
+                os.path.getsize(filename) / 1024,
+                os.path.getsize(rest.Database._computeJsonFilename(filename)) / 1024)
+    finally:
+        shutil.rmtree(tmpDir)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,77 @@
+#!/usr/bin/env python
+#
+#    Guernsey - Library to simplify creating REST web services using Python and Twisted
+#    Copyright (C) 2016 Ingemar Nilsson
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+#
+# Measures loading a JSON database with its tables decoded in the
+# loading process, and in a number of worker processes
+#
+
+import guernsey.db as db
+import guernsey.web.model as gwm
+
+import optparse, os, shutil, tempfile, time
+
+class EventModel(gwm.Model):
+    pass
+
+class BenchmarkDatabase(db.Database):
+    preferJson = True
+    tableCount = 8
+
+    def __init__(self):
+        db.Database.__init__(self)
+        for i in xrange(self.tableCount):
+            setattr(self, "events%d" % i, db.Table("events%d" % i))
+
+def main():
+    parser = optparse.OptionParser(usage="Usage: %prog [OPTIONS]")
+    parser.add_option("-n", "--size", action="store", type="int", dest="size",
+                      help="Number of records per table (Default: %default)")
+    parser.add_option("-t", "--tables", action="store", type="int", dest="tables",
+                      help="Number of tables (Default: %default)")
+    parser.add_option("-p", "--processes", action="append", type="int", dest="processes",
+                      help="Number of worker processes to measure; can be given "
+                      "multiple times (Default: 0, 2 and 4)")
+    parser.set_defaults(size=25000, tables=8, processes=[])
+    options, args = parser.parse_args()
+
+    BenchmarkDatabase.tableCount = options.tables
+    database = BenchmarkDatabase()
+    for tableName, table in database._iterTables():
+        for i in xrange(options.size):
+            table.set(str(i), EventModel({"name": "event-%d" % i,
+                                          "tags": ["a", "b", "c"],
+                                          "attributes": {"size": i, "source": "benchmark"}}))
+
+    tmpDir = tempfile.mkdtemp()
+    try:
+        filename = os.path.join(tmpDir, "benchmark.db")
+        database.save(filename)
+        print "Loading %d tables of %d records" % (options.tables, options.size)
+        for processes in options.processes or [0, 2, 4]:
+            BenchmarkDatabase.loadProcesses = processes
+            start = time.time()
+            BenchmarkDatabase.load(filename)
+            elapsed = time.time() - start
+            print "%-32s %10.3f ms" % ("%d processes" % processes, elapsed * 1000)
+    finally:
+        shutil.rmtree(tmpDir)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,58 @@
+#!/usr/bin/env python
+#
+#    Guernsey - Library to simplify creating REST web services using Python and Twisted
+#    Copyright (C) 2016 Ingemar Nilsson
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+#
+# Compares creating models from record dicts one at a time with the
+# constructor and in bulk with fromRecords()
+#
+
+import guernsey.web.model as gwm
+
+import optparse, time
+
+class EventModel(gwm.Model):
+    pass
+
+class SlottedEventModel(gwm.SlottedModel):
+    fields = ("name", "source", "priority", "size")
+
+def main():
+    parser = optparse.OptionParser(usage="Usage: %prog [OPTIONS]")
+    parser.add_option("-n", "--size", action="store", type="int", dest="size",
+                      help="Number of records (Default: %default)")
+    parser.set_defaults(size=200000)
+    options, args = parser.parse_args()
+
+    records = [{"name": "event-%d" % i, "source": "benchmark", "priority": i % 10, "size": i}
+               for i in xrange(options.size)]
+
+    for modelClass in [EventModel, SlottedEventModel]:
+        start = time.time()
+        models = [modelClass(record) for record in records]
+        elapsed = time.time() - start
+        print "%-40s %10.3f ms" % ("%s(record)" % modelClass.__name__, elapsed * 1000)
+
+        start = time.time()
+        models = modelClass.fromRecords(records)
+        elapsed = time.time() - start
+        print "%-40s %10.3f ms" % ("%s.fromRecords(records)" % modelClass.__name__,
+                                   elapsed * 1000)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,75 @@
+#!/usr/bin/env python
+#
+#    Guernsey - Library to simplify creating REST web services using Python and Twisted
+#    Copyright (C) 2016 Ingemar Nilsson
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+#
+# Compares the memory used by records of Model and SlottedModel
+# classes with the same attributes, and the time to fill a table and
+# read it back with copies
+#
+
+import guernsey.db as db
+import guernsey.web.model as gwm
+
+import cPickle as pickle
+import optparse, sys, time
+
+class EventModel(gwm.Model):
+    pass
+
+class SlottedEventModel(gwm.SlottedModel):
+    fields = ("name", "source", "priority", "size")
+
+def getSize(model):
+    size = sys.getsizeof(model)
+    if hasattr(model, "__dict__"):
+        size += sys.getsizeof(model.__dict__)
+    return size
+
+def main():
+    parser = optparse.OptionParser(usage="Usage: %prog [OPTIONS]")
+    parser.add_option("-n", "--size", action="store", type="int", dest="size",
+                      help="Number of records (Default: %default)")
+    parser.set_defaults(size=100000)
+    options, args = parser.parse_args()
+
+    print "%-20s %14s %14s %12s %12s" % ("model", "bytes/record", "pickled bytes",
+                                         "fill ms", "read ms")
+    for modelClass in [EventModel, SlottedEventModel]:
+        table = db.Table("events")
+        start = time.time()
+        for i in xrange(options.size):
+            table.set(str(i), modelClass({"name": "event-%d" % i,
+                                          "source": "benchmark",
+                                          "priority": i % 10,
+                                          "size": i}))
+        fillTime = time.time() - start
+
+        start = time.time()
+        for id, model in table.iteritems():
+            pass
+        readTime = time.time() - start
+
+        models = table.getAll(getCopy=False).values()
+        overhead = sum(getSize(model) for model in models) / float(len(models))
+        pickled = len(pickle.dumps(models[0], pickle.HIGHEST_PROTOCOL))
+        print "%-20s %14.1f %14d %12.3f %12.3f" % (modelClass.__name__, overhead, pickled,
+                                                   fillTime * 1000, readTime * 1000)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,79 @@
+#!/usr/bin/env python
+#
+#    Guernsey - Library to simplify creating REST web services using Python and Twisted
+#    Copyright (C) 2016 Ingemar Nilsson
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+#
+# Measures the time of rendering a small JSON resource through a
+# twisted.web site, at different log levels and with and without the
+# access log
+#
+
+import guernsey.web.rest as rest
+
+from twisted.web import server
+from twisted.web.test.requesthelper import DummyChannel
+
+import logging, optparse, time
+
+class HelloResource(rest.Resource):
+    def getJson(self, request):
+        return {"message": "Hello"}
+
+class NullHandler(logging.Handler):
+    def emit(self, record):
+        pass
+
+def renderRequests(site, count):
+    start = time.time()
+    for i in xrange(count):
+        channel = DummyChannel()
+        channel.site = site
+        request = server.Request(channel, False)
+        request.gotLength(0)
+        request.requestHeaders.setRawHeaders("Accept", ["application/json"])
+        request.requestReceived("GET", "/hello/", "HTTP/1.1")
+    return time.time() - start
+
+def main():
+    parser = optparse.OptionParser(usage="Usage: %prog [OPTIONS]")
+    parser.add_option("-n", "--requests", action="store", type="int", dest="requests",
+                      help="Number of requests per variant (Default: %default)")
+    parser.set_defaults(requests=5000)
+    options, args = parser.parse_args()
+
+    rootLogger = logging.getLogger()
+    rootLogger.addHandler(NullHandler())
+    accessLogger = logging.getLogger("guernsey.access.benchmark")
+    accessLogger.propagate = False
+    accessLogger.setLevel(logging.INFO)
+    accessLogger.addHandler(NullHandler())
+
+    root = rest.Resource()
+    root.putChild("hello", HelloResource(root))
+    site = server.Site(root)
+
+    for level, accessLog in [("WARNING", False), ("WARNING", True),
+                             ("INFO", False), ("DEBUG", False)]:
+        rootLogger.setLevel(getattr(logging, level))
+        rest.Resource.accessLogger = accessLogger if accessLog else None
+        elapsed = renderRequests(site, options.requests)
+        name = "%s%s" % (level, " + access log" if accessLog else "")
+        print "%-32s %10.1f us/request" % (name, elapsed * 1e6 / options.requests)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,93 @@
+#!/usr/bin/env python
+#
+#    Guernsey - Library to simplify creating REST web services using Python and Twisted
+#    Copyright (C) 2016 Ingemar Nilsson
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+#
+# Compares inserting records into an indexed, journaled table one at
+# a time with inserting them in a single batch
+#
+
+import guernsey.db as db
+import guernsey.web.model as gwm
+
+import optparse, os, shutil, tempfile, time
+
+class EventModel(gwm.Model):
+    pass
+
+class BenchmarkDatabase(db.Database):
+    def __init__(self):
+        db.Database.__init__(self)
+        self.events = db.Table("events")
+        self.events.addIndex(db.HashIndex("source"))
+        self.events.addIndex(db.SortedIndex("priority"))
+
+def createModels(size):
+    return [(str(i), EventModel({"name": "event-%d" % i,
+                                 "source": "source-%d" % (i % 10),
+                                 "priority": (i * 7919) % size}))
+            for i in xrange(size)]
+
+def insertSingle(database, models):
+    for id, model in models:
+        database.events.set(id, model)
+
+def insertBatch(database, models):
+    with database.events.batch() as batch:
+        for id, model in models:
+            batch.set(id, model)
+
+def measure(func, models, journalDir):
+    database = BenchmarkDatabase()
+    # Build the (empty) index up front, as in a running application
+    database.events.find("source", None)
+    if journalDir:
+        database.enableJournal(os.path.join(journalDir, "benchmark.db"))
+    start = time.time()
+    func(database, models)
+    database.sync()
+    # Includes rebuilding the index, if the batch dropped it
+    database.events.find("source", "source-0", getCopy=False)
+    elapsed = time.time() - start
+    database.disableJournal()
+    return elapsed
+
+def main():
+    parser = optparse.OptionParser(usage="Usage: %prog [OPTIONS]")
+    parser.add_option("-n", "--size", action="store", type="int", dest="size",
+                      help="Number of records to insert (Default: %default)")
+    parser.set_defaults(size=100000)
+    options, args = parser.parse_args()
+
+    models = createModels(options.size)
+    journalDir = tempfile.mkdtemp()
+    try:
+        print "Inserting %d records" % options.size
+        for journal in [False, True]:
+            for name, func in [("set()", insertSingle), ("batch()", insertBatch)]:
+                if journal:
+                    name += " (journal)"
+                    shutil.rmtree(journalDir)
+                    os.mkdir(journalDir)
+                elapsed = measure(func, models, journal and journalDir)
+                print "%-32s %10.3f ms" % (name, elapsed * 1000)
+    finally:
+        shutil.rmtree(journalDir)
+
+if __name__ == '__main__':
+    main()
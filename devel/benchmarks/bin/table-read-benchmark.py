@@ -0,0 +1,62 @@
+#!/usr/bin/env python
+#
+#    Guernsey - Library to simplify creating REST web services using Python and Twisted
+#    Copyright (C) 2016 Ingemar Nilsson
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+#
+# Compares the cost of reading a whole table with deep copies,
+# per-record copies, read-only views and no protection at all
+#
+
+import guernsey.db as db
+import guernsey.web.model as gwm
+
+import optparse, timeit
+
+class EventModel(gwm.Model):
+    pass
+
+def createTable(size):
+    table = db.Table("events")
+    for i in xrange(size):
+        table.set(str(i), EventModel({"name": "event-%d" % i,
+                                      "tags": ["a", "b", "c"],
+                                      "attributes": {"size": i, "source": "benchmark"}}))
+    return table
+
+def main():
+    parser = optparse.OptionParser(usage="Usage: %prog [OPTIONS]")
+    parser.add_option("-n", "--size", action="store", type="int", dest="size",
+                      help="Number of records in the table (Default: %default)")
+    parser.add_option("-r", "--repeat", action="store", type="int", dest="repeat",
+                      help="Number of repetitions (Default: %default)")
+    parser.set_defaults(size=10000, repeat=10)
+    options, args = parser.parse_args()
+
+    table = createTable(options.size)
+    variants = [("iteritems() (deep copy)", lambda: list(table.iteritems())),
+                ("iterviews() (read-only views)", lambda: list(table.iterviews())),
+                ("iterstream() (per-record copies)", lambda: list(table.iterstream())),
+                ("iteritems(getCopy=False)", lambda: list(table.iteritems(getCopy=False)))]
+
+    print "Reading %d records, %d repetitions" % (options.size, options.repeat)
+    for name, func in variants:
+        elapsed = min(timeit.repeat(func, number=1, repeat=options.repeat))
+        print "%-32s %10.3f ms" % (name, elapsed * 1000)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,219 @@
+#!/usr/bin/env python
+#
+#    Guernsey - Library to simplify creating REST web services using Python and Twisted
+#    Copyright (C) 2016 Ingemar Nilsson
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+#
+# Kills a process in the middle of saving a database, once before
+# each file operation of the save (fsync, rename and unlink), and
+# checks that the database can still be loaded afterwards, and that
+# it contains either the previous or the new save, never a mix. With
+# the journal enabled, no change may be lost. Also cuts the last
+# journal record at every byte, as a crash in the middle of an append
+# would, and checks that the database can be loaded, changed and
+# loaded again.
+#
+
+import guernsey.db as db
+
+import json, logging, optparse, os, shutil, sys, tempfile
+
+# Exit status of a child killed at the crash point
+CRASHED = 3
+
+class CrashTestDatabase(db.Database):
+    def __init__(self):
+        db.Database.__init__(self)
+        self.first = db.Table("first")
+        self.second = db.LazyTable("second", self)
+
+def configure(preferJson, preferContainer, compression):
+    CrashTestDatabase.preferJson = preferJson
+    CrashTestDatabase.preferContainer = preferContainer
+    CrashTestDatabase.compression = compression
+
+def change(database, start, count):
+    # Changes both tables in the same way, so that a load mixing
+    # files of different saves shows up as different sizes
+    for i in xrange(start, start + count):
+        database.first.set(str(i), {"value": i})
+        database.second.set(str(i), {"value": i})
+
+def crashAt(crashPoint):
+    # Makes the process exit right before the crashPoint:th call to
+    # one of the file operations of a save
+    calls = [0]
+
+    def wrap(name):
+        function = getattr(os, name)
+
+        def wrapper(*args):
+            calls[0] += 1
+            if calls[0] == crashPoint:
+                os._exit(CRASHED)
+            return function(*args)
+        setattr(os, name, wrapper)
+
+    for name in ["fsync", "rename", "unlink"]:
+        wrap(name)
+
+def checkManifest(filename):
+    # The files named by the manifest must have the recorded checksums
+    manifest = CrashTestDatabase._loadManifest(filename)
+    if not manifest:
+        return []
+    errors = []
+    directory = os.path.dirname(filename)
+    for name, entry in manifest["files"].iteritems():
+        path = os.path.join(directory, name)
+        if os.path.exists(path) and CrashTestDatabase._matchesManifest(manifest, path) \
+                and db.describeFile(path) != entry[:2]:
+            errors.append("%s does not match its checksum in the manifest" % name)
+    return errors
+
+def run(options, journal, crashPoint):
+    # Returns (crashed, errors)
+    tmpDir = tempfile.mkdtemp()
+    try:
+        filename = os.path.join(tmpDir, "crash-test.db")
+        database = CrashTestDatabase()
+        if journal:
+            database.enableJournal(filename)
+        change(database, 0, options.size)
+        if not database.checkpoint(filename):
+            return False, ["Initial save failed"]
+        change(database, options.size, options.size)
+        database.sync()
+
+        pid = os.fork()
+        if pid == 0:
+            crashAt(crashPoint)
+            database.checkpoint(filename)
+            os._exit(0)
+        pid, status = os.waitpid(pid, 0)
+        crashed = os.WIFEXITED(status) and os.WEXITSTATUS(status) == CRASHED
+        if journal:
+            database.disableJournal()
+
+        try:
+            loaded = CrashTestDatabase.load(filename)
+        except Exception, e:
+            return crashed, ["Load failed: %s: %s" % (e.__class__.__name__, e)]
+        sizes = (len(loaded.first.getAll()), len(loaded.second.getAll()))
+        if journal:
+            expected = [(2 * options.size, 2 * options.size)]
+        else:
+            expected = [(options.size, options.size), (2 * options.size, 2 * options.size)]
+        errors = checkManifest(filename)
+        if sizes not in expected:
+            errors.append("Loaded %d and %d records, expected one of %s"
+                          % (sizes[0], sizes[1], expected))
+        return crashed, errors
+    finally:
+        shutil.rmtree(tmpDir)
+
+def runTornJournal(options, cut):
+    # Returns a list of errors
+    tmpDir = tempfile.mkdtemp()
+    try:
+        filename = os.path.join(tmpDir, "crash-test.db")
+        journalPath = CrashTestDatabase._computeJournalFilename(filename)
+        database = CrashTestDatabase()
+        database.enableJournal(filename)
+        change(database, 0, options.size)
+        database.checkpoint(filename)
+        change(database, options.size, options.size)
+        database.sync()
+        size = os.path.getsize(journalPath)
+        database.first.set("torn", {"value": None})
+        database.disableJournal()
+        if cut >= os.path.getsize(journalPath) - size:
+            return None
+        f = open(journalPath, "r+b")
+        f.truncate(os.path.getsize(journalPath) - cut)
+        f.close()
+
+        try:
+            loaded = CrashTestDatabase.load(filename)
+            loaded.enableJournal(filename)
+            change(loaded, 2 * options.size, options.size)
+            loaded.disableJournal()
+            loaded = CrashTestDatabase.load(filename)
+        except Exception, e:
+            return ["Load failed: %s: %s" % (e.__class__.__name__, e)]
+        sizes = (len(loaded.first.getAll()), len(loaded.second.getAll()))
+        expected = (3 * options.size, 3 * options.size)
+        if sizes != expected:
+            return ["Loaded %d and %d records, expected %s" % (sizes[0], sizes[1], expected)]
+        return []
+    finally:
+        shutil.rmtree(tmpDir)
+
+def main():
+    parser = optparse.OptionParser(usage="Usage: %prog [OPTIONS]")
+    parser.add_option("-n", "--size", action="store", type="int", dest="size",
+                      help="Number of records changed by each save (Default: %default)")
+    parser.add_option("-v", "--verbose", action="store_true", dest="verbose",
+                      help="Show the warnings logged while loading")
+    parser.set_defaults(size=100, verbose=False)
+    options, args = parser.parse_args()
+
+    logging.basicConfig(level=options.verbose and logging.WARNING or logging.CRITICAL)
+
+    failures = 0
+    print "%-8s %-10s %-12s %8s %8s" % ("journal", "format", "compression", "crashes", "errors")
+    for journal in [False, True]:
+        for fmt, preferJson, preferContainer in [("pickle", False, False),
+                                                  ("json", True, False),
+                                                  ("container", False, True)]:
+            for compression in [None, "gzip"]:
+                if preferContainer and compression:
+                    # Containers are never compressed
+                    continue
+                configure(preferJson, preferContainer, compression)
+                crashPoint = 1
+                errors = 0
+                while True:
+                    crashed, messages = run(options, journal, crashPoint)
+                    for message in messages:
+                        print "  crash point %d: %s" % (crashPoint, message)
+                    errors += len(messages)
+                    if not crashed:
+                        break
+                    crashPoint += 1
+                print "%-8s %-10s %-12s %8d %8d" % (journal and "yes" or "no", fmt,
+                                                    compression or "none", crashPoint - 1,
+                                                    errors)
+                failures += errors
+
+    configure(False, False, None)
+    cut = 1
+    errors = 0
+    while True:
+        messages = runTornJournal(options, cut)
+        if messages is None:
+            break
+        for message in messages:
+            print "  torn record cut by %d bytes: %s" % (cut, message)
+        errors += len(messages)
+        cut += 1
+    print "%-8s %-10s %-12s %8d %8d" % ("torn", "pickle", "none", cut - 1, errors)
+    failures += errors
+    sys.exit(failures and 1 or 0)
+
+if __name__ == "__main__":
+    main()
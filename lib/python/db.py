@@ -26,6 +26,20 @@ import os
 import cPickle as pickle
 import json
 import base64
+import struct
+import mmap
+import collections
+import datetime
+import types
+import bisect
+import gc
+import zlib
+import bz2
+import cStringIO
+import array
+import itertools
+import functools
+import operator
 
 import guernsey.util as util
 
@@ -38,10 +52,710 @@ class IdError(Exception):
     def __str__(self):
         return repr(self.msg)
 
+class ReadOnlyError(Exception):
+    def __init__(self, msg):
+        self.msg = msg
+
+    def __str__(self):
+        return repr(self.msg)
+
+class TableChangedError(Exception):
+    def __init__(self, msg):
+        self.msg = msg
+
+    def __str__(self):
+        return repr(self.msg)
+
+_immutableTypes = (basestring, int, long, float, bool, complex, type(None), frozenset,
+                   datetime.datetime, datetime.date, datetime.time, datetime.timedelta)
+
+def readOnly(value):
+    if isinstance(value, _immutableTypes) or isinstance(value, ReadOnlyView):
+        return value
+    if isinstance(value, tuple):
+        return tuple(readOnly(v) for v in value)
+    return ReadOnlyView(value)
+
+class ReadOnlyView(object):
+    # Read-only proxy for a model (or any other object) stored in a
+    # table, used instead of a deep copy. Attribute and item
+    # assignment raise ReadOnlyError, and values read through the
+    # view are wrapped in views themselves. Methods of the object are
+    # bound to the view, so methods modifying the object fail as
+    # well. The view reflects later changes to the object.
+    __slots__ = ["_ReadOnlyView__target"]
+    _mutatingMethods = frozenset(["append", "extend", "insert", "pop", "popitem", "remove",
+                                  "clear", "update", "setdefault", "add", "discard",
+                                  "sort", "reverse", "difference_update",
+                                  "intersection_update", "symmetric_difference_update"])
+
+    def __init__(self, target):
+        object.__setattr__(self, "_ReadOnlyView__target", target)
+
+    @property
+    def __class__(self):
+        return self.__target.__class__
+
+    def __getattr__(self, name):
+        target = self.__target
+        value = getattr(target, name)
+        if isinstance(value, types.MethodType) and value.im_self is target:
+            return types.MethodType(value.im_func, self)
+        if isinstance(value, types.BuiltinMethodType) and value.__self__ is target:
+            if name in self._mutatingMethods:
+                raise ReadOnlyError("Tried to call %s() on read-only view" % name)
+            return lambda *args, **kwargs: readOnly(value(*args, **kwargs))
+        if callable(value):
+            return value
+        return readOnly(value)
+
+    def __setattr__(self, name, value):
+        raise ReadOnlyError("Tried to set attribute %r on read-only view" % name)
+
+    def __delattr__(self, name):
+        raise ReadOnlyError("Tried to delete attribute %r on read-only view" % name)
+
+    def __getitem__(self, key):
+        return readOnly(self.__target[key])
+
+    def __setitem__(self, key, value):
+        raise ReadOnlyError("Tried to set item %r on read-only view" % (key,))
+
+    def __delitem__(self, key):
+        raise ReadOnlyError("Tried to delete item %r on read-only view" % (key,))
+
+    def __iter__(self):
+        for value in self.__target:
+            yield readOnly(value)
+
+    def __len__(self):
+        return len(self.__target)
+
+    def __contains__(self, value):
+        return value in self.__target
+
+    def __nonzero__(self):
+        return bool(self.__target)
+
+    def __eq__(self, other):
+        if isinstance(other, ReadOnlyView):
+            other = other._ReadOnlyView__target
+        return self.__target == other
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash(self.__target)
+
+    def __repr__(self):
+        return repr(self.__target)
+
+    def __str__(self):
+        return str(self.__target)
+
+    def __copy__(self):
+        return copy.copy(self.__target)
+
+    def __deepcopy__(self, memo):
+        return copy.deepcopy(self.__target, memo)
+
+    def __reduce_ex__(self, protocol):
+        return self.__target.__reduce_ex__(protocol)
+
+    def __json__(self):
+        # The JSON encoder only reads, so hand it the object itself
+        if hasattr(self.__target, "__json__"):
+            return self.__target.__json__()
+        return self.__target
+
+def syncDirectory(path):
+    # Makes renames and deletions of the files in the directory of
+    # path durable
+    fd = os.open(os.path.dirname(os.path.abspath(path)), os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+def describeFile(path):
+    # Returns the size and CRC-32 of the file, as recorded in database
+    # manifests
+    crc = 0
+    size = 0
+    f = open(path, "rb")
+    try:
+        while True:
+            data = f.read(1048576)
+            if not data:
+                break
+            crc = zlib.crc32(data, crc)
+            size += len(data)
+    finally:
+        f.close()
+    return [size, crc & 0xffffffff]
+
+class ChecksumWriter(object):
+    # Write-only file object passing everything written to it on to the
+    # file object fh, while computing its size and CRC-32 the way
+    # describeFile() does. Seeking back to overwrite earlier data
+    # makes the CRC unknown.
+    def __init__(self, fh):
+        self.fh = fh
+        self.size = 0
+        self.__position = 0
+        self.__crc = 0
+
+    def write(self, data):
+        if self.__position != self.size:
+            self.__crc = None
+        elif self.__crc is not None:
+            self.__crc = zlib.crc32(data, self.__crc)
+        self.fh.write(data)
+        self.__position += len(data)
+        self.size = max(self.size, self.__position)
+
+    def tell(self):
+        return self.__position
+
+    def seek(self, offset):
+        self.fh.seek(offset)
+        self.__position = offset
+
+    def describe(self):
+        # Returns what describeFile() would, or None if unknown
+        if self.__crc is None:
+            return None
+        return [self.size, self.__crc & 0xffffffff]
+
+class Journal(object):
+    logger = None
+    _headerFormat = "!I"
+    _headerSize = struct.calcsize(_headerFormat)
+
+    def __init__(self, filename, sequence=0):
+        if not self.__class__.logger:
+            self.__class__.logger = util.getLogger(self)
+        self.filename = filename
+        self.sequence = sequence
+        # New records must not follow a record torn by a crash, or
+        # they could never be read
+        for path in [self.rotatedFilename(filename), filename]:
+            self.truncateTornRecord(path)
+        self.__fh = open(filename, "ab")
+
+    def append(self, tableName, op, args):
+        self.sequence += 1
+        data = pickle.dumps((self.sequence, tableName, op, args), pickle.HIGHEST_PROTOCOL)
+        self.__fh.write(struct.pack(self._headerFormat, len(data)) + data)
+        return self.sequence
+
+    def flush(self, sync=True):
+        self.__fh.flush()
+        if sync:
+            os.fsync(self.__fh.fileno())
+
+    @staticmethod
+    def rotatedFilename(filename):
+        return "%s.old" % filename
+
+    def rotate(self):
+        # Move the current records aside, so that a snapshot can be
+        # written while new records keep going to a fresh file. If an
+        # earlier rotated file is still around (its snapshot failed),
+        # the current records are appended to it.
+        self.logger.debug("rotate()")
+        self.close()
+        rotated = self.rotatedFilename(self.filename)
+        if os.path.exists(rotated):
+            src = open(self.filename, "rb")
+            dest = open(rotated, "ab")
+            while True:
+                data = src.read(1048576)
+                if not data:
+                    break
+                dest.write(data)
+            src.close()
+            dest.flush()
+            os.fsync(dest.fileno())
+            dest.close()
+            os.unlink(self.filename)
+        else:
+            os.rename(self.filename, rotated)
+        self.__fh = open(self.filename, "ab")
+        syncDirectory(self.filename)
+        return rotated
+
+    def close(self):
+        if self.__fh:
+            self.flush()
+            self.__fh.close()
+            self.__fh = None
+
+    @classmethod
+    def readRecords(cls, filename):
+        if not cls.logger:
+            cls.logger = util.getLogger(cls)
+        f = open(filename, "rb")
+        try:
+            for record in cls.readRecordsFrom(f):
+                yield record
+            if f.read(1):
+                # A torn write from a crash, everything before it is intact
+                cls.logger.warning("Truncated record at end of journal %r", filename)
+        finally:
+            f.close()
+
+    @classmethod
+    def truncateTornRecord(cls, filename):
+        # Cuts off an incomplete record at the end of the journal file.
+        # Returns the number of bytes removed.
+        if not os.path.exists(filename):
+            return 0
+        f = open(filename, "r+b")
+        try:
+            size = os.fstat(f.fileno()).st_size
+            end = 0
+            while end + cls._headerSize <= size:
+                f.seek(end)
+                length, = struct.unpack(cls._headerFormat, f.read(cls._headerSize))
+                if end + cls._headerSize + length > size:
+                    break
+                end += cls._headerSize + length
+            if end == size:
+                return 0
+            cls.logger.warning("Removing truncated record at end of journal %r (%d bytes)",
+                               filename, size - end)
+            f.truncate(end)
+            f.flush()
+            os.fsync(f.fileno())
+            return size - end
+        finally:
+            f.close()
+
+    @classmethod
+    def readRecordsFrom(cls, f):
+        # Yields the complete records from the current position of the
+        # open journal file f, and leaves f at the start of the first
+        # incomplete record, if any. Used to follow a journal that is
+        # still being written.
+        while True:
+            start = f.tell()
+            header = f.read(cls._headerSize)
+            if len(header) < cls._headerSize:
+                break
+            length, = struct.unpack(cls._headerFormat, header)
+            data = f.read(length)
+            if len(data) < length:
+                break
+            yield pickle.loads(data)
+        f.seek(start)
+
+class GenerationFile(object):
+    # Small memory-mapped file where a database writer publishes the
+    # number of checkpoints and the last synced journal sequence, so
+    # that readers in other processes can poll it cheaply
+    _format = "!QQ"
+    _size = struct.calcsize(_format)
+
+    def __init__(self, filename, writable=False):
+        self.filename = filename
+        if writable:
+            fd = os.open(filename, os.O_RDWR | os.O_CREAT, 0644)
+            try:
+                if os.fstat(fd).st_size < self._size:
+                    os.ftruncate(fd, self._size)
+                self.__map = mmap.mmap(fd, self._size)
+            finally:
+                os.close(fd)
+        else:
+            f = open(filename, "rb")
+            try:
+                self.__map = mmap.mmap(f.fileno(), self._size, access=mmap.ACCESS_READ)
+            finally:
+                f.close()
+
+    def read(self):
+        # Read until two reads agree, in case the writer is in the
+        # middle of an update
+        while True:
+            data = self.__map[:self._size]
+            if self.__map[:self._size] == data:
+                return struct.unpack(self._format, data)
+
+    def write(self, checkpoints, sequence):
+        self.__map[:self._size] = struct.pack(self._format, checkpoints, sequence)
+
+    def close(self):
+        self.__map.close()
+
+class CompressionError(Exception):
+    def __init__(self, msg):
+        self.msg = msg
+
+    def __str__(self):
+        return repr(self.msg)
+
+class CompressedWriter(object):
+    # Write-only file object compressing everything written to it into
+    # the file object fh. finish() must be called before fh is closed.
+    def __init__(self, fh, compressor):
+        self.fh = fh
+        self.__compressor = compressor
+
+    def write(self, data):
+        data = self.__compressor.compress(data)
+        if data:
+            self.fh.write(data)
+
+    def finish(self):
+        self.fh.write(self.__compressor.flush())
+
+class Compression(object):
+    # Compression codecs for database snapshot files, by name: the
+    # magic bytes starting a compressed file, and functions creating a
+    # compressor (given a level) and a decompressor
+    codecs = {
+        "zlib": (("\x78\x01", "\x78\x5e", "\x78\x9c", "\x78\xda"),
+                 lambda level: zlib.compressobj(level),
+                 zlib.decompressobj),
+        "gzip": (("\x1f\x8b",),
+                 lambda level: zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS),
+                 lambda: zlib.decompressobj(16 + zlib.MAX_WBITS)),
+        "bz2": (("BZh",),
+                lambda level: bz2.BZ2Compressor(level),
+                bz2.BZ2Decompressor),
+        }
+    _blockSize = 1048576
+
+    @classmethod
+    def writer(cls, fh, codec, level):
+        if codec not in cls.codecs:
+            raise CompressionError("Unknown compression codec %r" % codec)
+        return CompressedWriter(fh, cls.codecs[codec][1](level))
+
+    @classmethod
+    def detect(cls, header):
+        for codec, (magics, compressor, decompressor) in cls.codecs.iteritems():
+            for magic in magics:
+                if header.startswith(magic):
+                    return codec
+        return None
+
+    @classmethod
+    def open(cls, filename):
+        # Opens a snapshot file for reading. Compressed files are
+        # decompressed block by block into memory, since unpickling
+        # from a Python file object is much slower than from a string.
+        f = open(filename, "rb")
+        codec = cls.detect(f.read(4))
+        f.seek(0)
+        if not codec:
+            return f
+        try:
+            decompressor = cls.codecs[codec][2]()
+            chunks = []
+            while True:
+                data = f.read(cls._blockSize)
+                if not data:
+                    break
+                chunks.append(decompressor.decompress(data))
+            if hasattr(decompressor, "flush"):
+                chunks.append(decompressor.flush())
+        finally:
+            f.close()
+        return cStringIO.StringIO("".join(chunks))
+
+class DetachedTableError(Exception):
+    def __init__(self, msg):
+        self.msg = msg
+
+    def __str__(self):
+        return repr(self.msg)
+
+class ContainerError(Exception):
+    def __init__(self, msg):
+        self.msg = msg
+
+    def __str__(self):
+        return repr(self.msg)
+
+class RawSection(object):
+    # A container section written by a function instead of pickled,
+    # e.g. the records of a LazyTable. When reading, the payload is
+    # not read, only its position in the file is recorded.
+    def __init__(self, writer=None, filename=None, offset=None, length=None):
+        self.writer = writer
+        self.filename = filename
+        self.offset = offset
+        self.length = length
+
+class TableContainer(object):
+    # File format: a magic string followed by sections, each being a
+    # section header (name length, section type, payload length), the
+    # name and the payload. The payload is either pickled or raw
+    # bytes. The last section is always named "_end". Sections are
+    # written and read one at a time, so memory use is bounded by the
+    # largest table rather than the whole database. Payload lengths
+    # are known before writing where possible, so that the file is
+    # written from start to end without seeking back.
+    magic = "GUERNSEYDB\x01\n"
+    endSection = "_end"
+    _headerFormat = "!HBQ"
+    _headerSize = struct.calcsize(_headerFormat)
+    _pickledSection = 0
+    _rawSection = 1
+
+    @classmethod
+    def write(cls, fh, sections):
+        fh.write(cls.magic)
+        for name, obj in sections:
+            cls._writeSection(fh, name, obj)
+        cls._writeSection(fh, cls.endSection, None)
+
+    @classmethod
+    def _writeSection(cls, fh, name, obj):
+        if not isinstance(obj, RawSection):
+            payload = pickle.dumps(obj, pickle.HIGHEST_PROTOCOL)
+            fh.write(struct.pack(cls._headerFormat, len(name), cls._pickledSection,
+                                 len(payload)) + name)
+            fh.write(payload)
+            return
+        sectionType = cls._rawSection
+        if obj.length is not None:
+            fh.write(struct.pack(cls._headerFormat, len(name), sectionType, obj.length) + name)
+            start = fh.tell()
+            obj.writer(fh)
+            if fh.tell() - start != obj.length:
+                raise ContainerError("Section %r is %d bytes, expected %d"
+                                     % (name, fh.tell() - start, obj.length))
+            return
+        headerPos = fh.tell()
+        fh.write(struct.pack(cls._headerFormat, len(name), sectionType, 0) + name)
+        start = fh.tell()
+        obj.writer(fh)
+        end = fh.tell()
+        # Patch in the payload length now that we know it
+        fh.seek(headerPos)
+        fh.write(struct.pack(cls._headerFormat, len(name), sectionType, end - start))
+        fh.seek(end)
+
+    @classmethod
+    def read(cls, fh):
+        if fh.read(len(cls.magic)) != cls.magic:
+            raise ContainerError("Not a table container file: %r" % fh.name)
+        while True:
+            header = fh.read(cls._headerSize)
+            if len(header) < cls._headerSize:
+                raise ContainerError("Truncated table container file: %r" % fh.name)
+            nameLength, sectionType, length = struct.unpack(cls._headerFormat, header)
+            name = fh.read(nameLength)
+            if name == cls.endSection:
+                return
+            start = fh.tell()
+            if sectionType == cls._rawSection:
+                obj = RawSection(filename=fh.name, offset=start, length=length)
+                fh.seek(start + length)
+            else:
+                try:
+                    obj = pickle.load(fh)
+                except (EOFError, pickle.UnpicklingError):
+                    raise ContainerError("Truncated section %r in table container file %r"
+                                         % (name, fh.name))
+            if fh.tell() != start + length:
+                raise ContainerError("Corrupt section %r in table container file %r"
+                                     % (name, fh.name))
+            yield name, obj
+
+class Index(object):
+    # Secondary index on a model attribute, maintained by the table.
+    # Declare indexes in the tableIndexes class attribute of a Table
+    # subclass, or add them with Table.addIndex(). Only the index
+    # definition is pickled; the contents are rebuilt when needed.
+    def __init__(self, attribute):
+        self.attribute = attribute
+        self.clear()
+
+    def __getstate__(self):
+        return {"attribute": self.attribute}
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.clear()
+
+    def __repr__(self):
+        return "%s(%r)" % (self.__class__.__name__, self.attribute)
+
+    def empty(self):
+        return self.__class__(self.attribute)
+
+    def getValue(self, id, element):
+        return getattr(element, self.attribute, None)
+
+    def build(self, items):
+        # Adds (id, element) pairs in bulk
+        for id, element in items:
+            self.add(id, self.getValue(id, element))
+
+class HashIndex(Index):
+    # Index for equality lookups
+    def clear(self):
+        self.ids = {}
+
+    def add(self, id, value):
+        self.ids.setdefault(value, set()).add(id)
+
+    def remove(self, id, value):
+        ids = self.ids.get(value)
+        if ids is not None:
+            ids.discard(id)
+            if not ids:
+                del self.ids[value]
+
+    def find(self, value):
+        return list(self.ids.get(value, ()))
+
+class SortedIndex(Index):
+    # Index for equality lookups, ranges and ordering. Values and ids
+    # are kept in two parallel lists sorted by value. Entries removed
+    # from the start of the lists are only skipped (start is the first
+    # live entry), and cut off in bulk, so that removing the smallest
+    # values one by one, e.g. when expiring the oldest records, is
+    # cheap.
+    _minCompactSize = 1024
+
+    def clear(self):
+        self.values = []
+        self.ids = []
+        self.start = 0
+
+    def add(self, id, value):
+        pos = bisect.bisect_right(self.values, value, self.start)
+        self.values.insert(pos, value)
+        self.ids.insert(pos, id)
+
+    def remove(self, id, value):
+        lo = bisect.bisect_left(self.values, value, self.start)
+        hi = bisect.bisect_right(self.values, value, lo)
+        for pos in xrange(lo, hi):
+            if self.ids[pos] == id:
+                if pos == self.start:
+                    self.ids[pos] = None
+                    self.start += 1
+                    self.__compact()
+                else:
+                    del self.values[pos]
+                    del self.ids[pos]
+                return
+
+    def __compact(self):
+        if self.start >= self._minCompactSize and self.start * 2 >= len(self.values):
+            del self.values[:self.start]
+            del self.ids[:self.start]
+            self.start = 0
+
+    def build(self, items):
+        # Sorting once is much cheaper than inserting one at a time
+        pairs = [(self.getValue(id, element), id) for id, element in items]
+        pairs.extend(zip(self.values[self.start:], self.ids[self.start:]))
+        pairs.sort(key=lambda pair: pair[0])
+        self.values = [value for value, id in pairs]
+        self.ids = [id for value, id in pairs]
+        self.start = 0
+
+    def find(self, value):
+        return self.findRange(value, value)
+
+    def findRange(self, low=None, high=None, reverse=False, limit=None, offset=0):
+        # Only the requested slice of ids is copied
+        if low is None:
+            lo = self.start
+        else:
+            lo = bisect.bisect_left(self.values, low, self.start)
+        if high is None:
+            hi = len(self.values)
+        else:
+            hi = bisect.bisect_right(self.values, high, lo)
+        if reverse:
+            end = max(lo, hi - offset)
+            start = lo
+            if limit is not None:
+                start = max(lo, end - limit)
+            return self.ids[start:end][::-1]
+        start = min(hi, lo + offset)
+        end = hi
+        if limit is not None:
+            end = min(hi, start + limit)
+        return self.ids[start:end]
+
+class Batch(object):
+    # Mutations of a table collected by Table.batch() or
+    # Database.transaction(). They are applied together when the with
+    # block exits, or not at all if it raises an exception.
+    def __init__(self, table):
+        self.table = table
+        self.operations = []
+
+    def __len__(self):
+        return len(self.operations)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, excType, excValue, traceback):
+        if excType is None:
+            self.table.applyBatch(self.operations)
+        return False
+
+    def set(self, id, model):
+        self.operations.append(("set", (id, model)))
+
+    def update(self, id, model, createIfNotFound=False):
+        self.operations.append(("update", (id, model, createIfNotFound)))
+
+    def delete(self, id):
+        self.operations.append(("delete", (id,)))
+
+class Transaction(object):
+    # Batches of mutations of several tables, see Database.transaction()
+    def __init__(self, database):
+        self.database = database
+        self.batches = collections.OrderedDict()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, excType, excValue, traceback):
+        if excType is None:
+            self.database.applyTransaction(self.batches.values())
+        return False
+
+    def batch(self, table):
+        batch = self.batches.get(__builtin__.id(table))
+        if batch is None:
+            batch = Batch(table)
+            self.batches[__builtin__.id(table)] = batch
+        return batch
+
 class Table(object):
     __deepcopy = True
     logger = None
     __database = None
+    __journal = None
+    __journalName = None
+    __generation = 0
+    __snapshots = 0
+    __source = None
+    __addedIndexes = ()
+    __indexes = None
+    __missing = object()
+    tableIndexes = []
+
+    _transientAttributes = ["_Table__journal",
+                            "_Table__journalName",
+                            "_Table__snapshots",
+                            "_Table__source",
+                            "_Table__indexes"]
 
     def __init__(self, tableName, database=None, deepCopy=True):
         self.__tableName = tableName
@@ -51,6 +765,12 @@ class Table(object):
         if not self.__class__.logger:
             self.__class__.logger = util.getLogger(self)
 
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        for k in self._transientAttributes:
+            state.pop(k, None)
+        return state
+
     def __setstate__(self, state):
         self.__dict__.update(state)
         if not self.__class__.logger:
@@ -62,6 +782,112 @@ class Table(object):
     def setDatabase(self, database):
         self.__database = database
 
+    def setJournal(self, journal, name=None):
+        self.__journal = journal
+        self.__journalName = name or self.__tableName
+
+    def getGeneration(self):
+        return self.__generation
+
+    def markDirty(self):
+        # Call this after modifying a model fetched with getCopy=False,
+        # otherwise the change may not be included in the next save
+        self.__generation += 1
+
+    def _recordChange(self, op, *args):
+        self.markDirty()
+        if self.__journal:
+            self.__journal.append(self.__journalName, op, args)
+
+    def _replayJournalRecord(self, op, args):
+        getattr(self, op)(*args)
+
+    def snapshot(self):
+        # Cheap point-in-time copy for saving in another thread. Only
+        # the dict is copied; the models are shared, and update()
+        # copies a model before modifying it while snapshots exist.
+        snapshot = copy.copy(self)
+        setattr(snapshot, self.__tableName, self.__getTable().copy())
+        snapshot.__source = self
+        self.__snapshots += 1
+        return snapshot
+
+    def releaseSnapshot(self):
+        if self.__source:
+            self.__source.__snapshots -= 1
+            self.__source = None
+
+    def _getSource(self):
+        return self.__source or self
+
+    def addIndex(self, index):
+        self.__addedIndexes = tuple(self.__addedIndexes) + (index,)
+        self.__indexes = None
+
+    def _isIndexed(self):
+        return self.__indexes is not None
+
+    def _getIndexDefinitions(self):
+        return list(self.tableIndexes) + list(self.__addedIndexes)
+
+    def __getIndexes(self):
+        # Indexes are built on first use, e.g. after loading
+        if self.__indexes is None:
+            indexes = [index.empty() for index in self._getIndexDefinitions()]
+            items = self.iteritems(getCopy=False)
+            if len(indexes) > 1:
+                items = list(items)
+            for index in indexes:
+                index.build(items)
+            self.__indexes = indexes
+        return self.__indexes
+
+    def __findIndex(self, attribute, indexClass=Index):
+        for index in self.__getIndexes():
+            if index.attribute == attribute and isinstance(index, indexClass):
+                return index
+        return None
+
+    def _index(self, id, element):
+        if self.__indexes is not None and element is not None:
+            for index in self.__indexes:
+                index.add(id, index.getValue(id, element))
+
+    def _unindex(self, id, element):
+        if self.__indexes is not None and element is not None:
+            for index in self.__indexes:
+                index.remove(id, index.getValue(id, element))
+
+    def __getIndexed(self, ids, getCopy):
+        return [(id, self.get(id, getCopy=getCopy)) for id in ids]
+
+    def find(self, attribute, value, getCopy=True):
+        # Returns a list of (id, model) pairs whose attribute equals
+        # value, using an index on the attribute if there is one
+        index = self.__findIndex(attribute, HashIndex) or self.__findIndex(attribute)
+        if index:
+            ids = index.find(value)
+        else:
+            ids = [id for id, element in self.iteritems(getCopy=False)
+                   if getattr(element, attribute, None) == value]
+        return self.__getIndexed(ids, getCopy)
+
+    def findRange(self, attribute, low=None, high=None, reverse=False, limit=None, offset=0,
+                  getCopy=True):
+        # Returns a list of (id, model) pairs ordered by attribute,
+        # with low <= attribute <= high (None means unbounded), using
+        # a sorted index on the attribute if there is one
+        index = self.__findIndex(attribute, SortedIndex)
+        if not index:
+            index = SortedIndex(attribute)
+            index.build(self.iteritems(getCopy=False))
+        ids = index.findRange(low, high, reverse, limit, offset)
+        return self.__getIndexed(ids, getCopy)
+
+    def orderBy(self, attribute, reverse=False, limit=None, offset=0, getCopy=True):
+        return self.findRange(attribute, reverse=reverse, limit=limit, offset=offset,
+                              getCopy=getCopy)
+
     def __getTable(self, getCopy=False):
         table = getattr(self, self.__tableName)
         if getCopy:
@@ -72,18 +898,52 @@ class Table(object):
         else:
             return table
     
+    def getTableName(self):
+        return self.__tableName
+
+    def _copyElement(self, element):
+        if self.__deepcopy:
+            return copy.deepcopy(element)
+        else:
+            return copy.copy(element)
+
     def get(self, id, default=None, getCopy=True):
         element = self.__getTable().get(id, default)
         if getCopy:
-            if self.__deepcopy:
-                return copy.deepcopy(element)
-            else:
-                return copy.copy(element)
+            return self._copyElement(element)
         else:
             return element
 
+    def getView(self, id, default=None):
+        element = self.get(id, getCopy=False)
+        if element is None:
+            return default
+        return readOnly(element)
+
     def getAll(self, getCopy=True):
         return self.__getTable(getCopy)
+
+    def iterviews(self):
+        # Like iteritems(), but yields read-only views instead of
+        # copying the whole table first
+        for id, element in self.iteritems(getCopy=False):
+            yield id, readOnly(element)
+
+    def iterstream(self, views=False):
+        # Like iteritems(), but copies one record at a time (or wraps
+        # it in a read-only view) instead of copying the whole table
+        # first. If the table is modified before the iteration is
+        # finished, TableChangedError is raised, so all records seen
+        # are from the same state of the table.
+        generation = self.__generation
+        for id, element in self.iteritems(getCopy=False):
+            if views:
+                yield id, readOnly(element)
+            else:
+                yield id, self._copyElement(element)
+            if self.__generation != generation:
+                raise TableChangedError("Table '%s' was modified during iteration" %
+                                        self.__tableName)
     
     def iteritems(self, getCopy=True):
         table = self.__getTable(getCopy)
@@ -94,57 +954,720 @@ class Table(object):
         return table.iterkeys()
 
     def itervalues(self, getCopy=True):
-        table = self.__getTable(getCopy)
-        return table.itervalues()
+        table = self.__getTable(getCopy)
+        return table.itervalues()
+
+    def set(self, id, model):
+        if id is __builtin__.id:
+            raise IdError("Tried to set model with builtin function id as key")
+        table = self.__getTable()
+        self._unindex(id, table.get(id))
+        table[id] = model
+        self._index(id, model)
+        self._recordChange("set", id, model)
+
+    def update(self, id, model, createIfNotFound=False):
+        if id is __builtin__.id:
+            raise IdError("Tried to update model with builtin function id as key")
+        element = self.__getTable().get(id)
+        if element:
+            if self.__snapshots:
+                element = copy.copy(element)
+                self.__getTable()[id] = element
+            self._unindex(id, element)
+            element.update(model)
+            self._index(id, element)
+        elif createIfNotFound:
+            self.__getTable()[id] = model
+            self._index(id, model)
+        else:
+            raise KeyError("Table '%s' has no key '%s'" % (self.__tableName, id))
+        self._recordChange("update", id, model, createIfNotFound)
+
+    def delete(self, id):
+        if id is __builtin__.id:
+            raise IdError("Tried to delete model with builtin function id as key")
+        element = self.__getTable().get(id)
+        if element:
+            self._unindex(id, element)
+            del self.__getTable()[id]
+        else:
+            raise KeyError("Table '%s' has no key '%s'" % (self.__tableName, id))
+        self._recordChange("delete", id)
+
+    def clear(self):
+        table = self.__getTable()
+        table.clear()
+        if self.__indexes is not None:
+            for index in self.__indexes:
+                index.clear()
+        self._recordChange("clear")
+
+    def batch(self):
+        # Usage:
+        #     with table.batch() as batch:
+        #         batch.set(id, model)
+        #         ...
+        return Batch(self)
+
+    def applyBatch(self, operations):
+        # Atomically applies a list of (op, args) pairs, where op is
+        # "set", "update" or "delete" and args are the arguments of
+        # that method. The changes are journaled as a single record.
+        self._applyOperations(operations)
+        self._recordChange("applyBatch", operations)
+
+    def _applyOperations(self, operations):
+        # Applies operations without journaling, and returns the
+        # previous models of the affected ids for rollback. If an
+        # operation fails, the earlier ones are rolled back.
+        table = self.__getTable()
+        if self.__indexes is not None and len(operations) > len(table) / 4:
+            # Cheaper to rebuild the indexes on next use
+            self.__indexes = None
+        missing = self.__missing
+        previous = {}
+        # Skip the index hooks unless there are indexes, or a subclass
+        # relies on them
+        hooks = self.__indexes is not None or \
+            self._index.im_func is not Table._index.im_func or \
+            self._unindex.im_func is not Table._unindex.im_func
+        try:
+            for op, args in operations:
+                id = args[0]
+                if id is __builtin__.id:
+                    raise IdError("Tried to %s model with builtin function id as key" % op)
+                element = table.get(id, missing)
+                if id not in previous:
+                    previous[id] = element
+                    if element is not missing and element and op == "update":
+                        # The original is kept for rollback and snapshots
+                        element = copy.copy(element)
+                        table[id] = element
+                if element is missing:
+                    element = None
+
+                if op == "set":
+                    if hooks:
+                        self._unindex(id, element)
+                    element = table[id] = args[1]
+                elif op == "update":
+                    if element:
+                        if hooks:
+                            self._unindex(id, element)
+                        element.update(args[1])
+                    elif args[2]:
+                        element = table[id] = args[1]
+                    else:
+                        raise KeyError("Table '%s' has no key '%s'" % (self.__tableName, id))
+                elif op == "delete":
+                    if not element:
+                        raise KeyError("Table '%s' has no key '%s'" % (self.__tableName, id))
+                    if hooks:
+                        self._unindex(id, element)
+                    del table[id]
+                    continue
+                else:
+                    raise ValueError("Unknown batch operation %r" % op)
+                if hooks:
+                    self._index(id, element)
+        except:
+            Table._rollbackOperations(self, previous)
+            raise
+        return previous
+
+    def _rollbackOperations(self, previous):
+        table = self.__getTable()
+        for id, element in previous.iteritems():
+            self._unindex(id, table.get(id))
+            if element is self.__missing:
+                table.pop(id, None)
+            else:
+                table[id] = element
+                self._index(id, element)
+
+    def __repr__(self):
+        output = self.__class__.__name__ + "{"
+
+        members = []
+        for k, v in self.__dict__.iteritems():
+            if k in ["_Table__database", "logger"] + self._transientAttributes:
+                continue
+            members.append("%s: %r" % (k, v))
+
+        output += ", ".join(members) + "}"
+        return output
+
+class LazyTable(Table):
+    # Table that leaves its records in the table container file until
+    # they are used (see Database.preferContainer). Loading the table
+    # only reads an index of record positions, and the container file
+    # is memory-mapped. Decoded records are kept in a bounded cache.
+    #
+    # Records fetched with getCopy=False are shared with the cache,
+    # so change records through set() or update(). Records that are
+    # set or updated stay in memory until the database is reloaded.
+    # Saving to a pickle or JSON file decodes all records.
+    cacheSize = 1000
+    __index = None
+    __deleted = None
+    __records = None
+    __recordsOffset = 0
+    __recordsSection = None
+    __cache = None
+    __containerIndex = None
+
+    _transientAttributes = Table._transientAttributes + ["_LazyTable__records",
+                                                         "_LazyTable__recordsOffset",
+                                                         "_LazyTable__cache",
+                                                         "_LazyTable__containerIndex"]
+
+    def __init__(self, tableName, database=None, deepCopy=True):
+        Table.__init__(self, tableName, database, deepCopy)
+        self.__index = {}
+        self.__deleted = set()
+
+    def __getstate__(self):
+        state = Table.__getstate__(self)
+        if self.__containerIndex is not None:
+            # Records are written to a separate container section
+            state[self.getTableName()] = {}
+            state["_LazyTable__index"] = self.__containerIndex
+        else:
+            state[self.getTableName()] = dict(self.iteritems(getCopy=False))
+            state["_LazyTable__index"] = {}
+        state["_LazyTable__deleted"] = set()
+        return state
+
+    def __copy__(self):
+        # Unlike pickling, copying keeps the records on disk
+        new = self.__class__.__new__(self.__class__)
+        new.__dict__.update(self.__dict__)
+        for k in Table._transientAttributes:
+            new.__dict__.pop(k, None)
+        new.__deleted = set(self.__deleted)
+        new.__cache = None
+        return new
+
+    def __getOverlay(self):
+        return getattr(self, self.getTableName())
+
+    def __onDisk(self, id):
+        return id in self.__index and id not in self.__deleted
+
+    def __readRaw(self, id):
+        offset, length = self.__index[id]
+        start = self.__recordsOffset + offset
+        return self.__records[start:start + length]
+
+    def __getCached(self, id):
+        if self.__cache is None:
+            self.__cache = collections.OrderedDict()
+        element = self.__cache.pop(id, None)
+        if element is None:
+            element = pickle.loads(self.__readRaw(id))
+        self.__cache[id] = element
+        if len(self.__cache) > self.cacheSize:
+            self.__cache.popitem(last=False)
+        return element
+
+    def __uncache(self, id):
+        if self.__cache:
+            self.__cache.pop(id, None)
+
+    def __promote(self, id):
+        # Move a record from disk into memory before modifying it
+        self.__uncache(id)
+        self.__getOverlay()[id] = pickle.loads(self.__readRaw(id))
+
+    def _attachContainer(self, rawSections):
+        section = rawSections.get(self.__recordsSection)
+        if not section:
+            return
+        f = open(section.filename, "rb")
+        try:
+            self.__records = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        finally:
+            f.close()
+        self.__recordsOffset = section.offset
+
+    def _getContainerSections(self, tableName):
+        recordsSection = "%s:records" % tableName
+        index = {}
+        # Only the changed records are pickled up front, to know the
+        # length of the section before writing it
+        overlay = self.__getOverlay()
+        pickled = [(id, pickle.dumps(model, pickle.HIGHEST_PROTOCOL))
+                   for id, model in overlay.iteritems()]
+        copied = [id for id in self.__index if id not in overlay and id not in self.__deleted]
+        length = sum(len(data) for id, data in pickled) \
+            + sum(self.__index[id][1] for id in copied)
+
+        def writeRecords(fh):
+            offset = 0
+            for id, data in pickled:
+                index[id] = (offset, len(data))
+                fh.write(data)
+                offset += len(data)
+            for id in copied:
+                # Copied without decoding
+                data = self.__readRaw(id)
+                index[id] = (offset, len(data))
+                fh.write(data)
+                offset += len(data)
+
+        yield recordsSection, RawSection(writeRecords, length=length)
+        header = copy.copy(self)
+        header.__containerIndex = index
+        header.__recordsSection = recordsSection
+        yield tableName, header
+
+    def get(self, id, default=None, getCopy=True):
+        if id in self.__getOverlay() or not self.__onDisk(id):
+            return Table.get(self, id, default, getCopy)
+        element = self.__getCached(id)
+        if getCopy:
+            return self._copyElement(element)
+        else:
+            return element
+
+    def getAll(self, getCopy=True):
+        return dict(self.iteritems(getCopy))
+
+    def iteritems(self, getCopy=True):
+        overlay = self.__getOverlay()
+        for id, element in overlay.items():
+            if getCopy:
+                element = self._copyElement(element)
+            yield id, element
+        for id in self.__index.keys():
+            if id not in overlay and id not in self.__deleted:
+                # Decoded records are private copies already, and are
+                # not cached to avoid flushing the cache
+                yield id, pickle.loads(self.__readRaw(id))
+
+    def iterkeys(self, getCopy=True):
+        overlay = self.__getOverlay()
+        for id in overlay.keys():
+            yield id
+        for id in self.__index.keys():
+            if id not in overlay and id not in self.__deleted:
+                yield id
+
+    def itervalues(self, getCopy=True):
+        for id, element in self.iteritems(getCopy):
+            yield element
+
+    def set(self, id, model):
+        if self._isIndexed() and id not in self.__getOverlay() and self.__onDisk(id):
+            self.__promote(id)
+        self.__uncache(id)
+        Table.set(self, id, model)
+
+    def update(self, id, model, createIfNotFound=False):
+        if id not in self.__getOverlay() and self.__onDisk(id):
+            self.__promote(id)
+        Table.update(self, id, model, createIfNotFound)
+
+    def delete(self, id):
+        if id is __builtin__.id:
+            raise IdError("Tried to delete model with builtin function id as key")
+        overlay = self.__getOverlay()
+        if overlay.get(id):
+            self._unindex(id, overlay[id])
+            del overlay[id]
+        elif self.__onDisk(id):
+            if self._isIndexed():
+                self._unindex(id, pickle.loads(self.__readRaw(id)))
+        else:
+            raise KeyError("Table '%s' has no key '%s'" % (self.getTableName(), id))
+        if id in self.__index:
+            self.__deleted.add(id)
+            self.__uncache(id)
+        self._recordChange("delete", id)
+
+    def clear(self):
+        self.__deleted = set(self.__index)
+        if self.__cache:
+            self.__cache.clear()
+        Table.clear(self)
+
+    def _applyOperations(self, operations):
+        overlay = self.__getOverlay()
+        for op, args in operations:
+            id = args[0]
+            if id not in overlay and self.__onDisk(id) and (op != "set" or self._isIndexed()):
+                self.__promote(id)
+            else:
+                self.__uncache(id)
+        previous = Table._applyOperations(self, operations)
+        deleted = [id for id in previous
+                   if id in self.__index and id not in overlay and id not in self.__deleted]
+        self.__deleted.update(deleted)
+        return previous, deleted
+
+    def _rollbackOperations(self, undo):
+        previous, deleted = undo
+        self.__deleted.difference_update(deleted)
+        Table._rollbackOperations(self, previous)
+
+class ColumnarTable(Table):
+    # Table for many records of the same model class, storing each
+    # attribute in a column instead of one model object per record.
+    # Declare the model class and the columns in subclasses:
+    #
+    #     class MetricTable(db.ColumnarTable):
+    #         modelClass = MetricModel
+    #         columns = [("timestamp", "d"), ("value", "d"), ("name", None)]
+    #
+    # A column with an array typecode (see the array module) stores
+    # its values in an array.array, other columns in a list. If a
+    # value does not fit the array, e.g. None, the column is turned
+    # into a list. Attributes without a column are kept in a dict per
+    # record. Models are created when they are read, so change records
+    # through set() or update(). Unset column attributes read as None.
+    modelClass = None
+    columns = []
+    __ids = None
+    __positions = None
+    __columns = None
+    __extras = None
+
+    _transientAttributes = Table._transientAttributes + ["_ColumnarTable__positions"]
+
+    def __init__(self, tableName, database=None, deepCopy=True):
+        Table.__init__(self, tableName, database, deepCopy)
+        self.__clearColumns()
+
+    def __clearColumns(self):
+        self.__ids = []
+        self.__positions = {}
+        self.__columns = {}
+        for attribute, typecode in self.columns:
+            if typecode:
+                self.__columns[attribute] = array.array(typecode)
+            else:
+                self.__columns[attribute] = []
+        self.__extras = []
+
+    def __getstate__(self):
+        state = Table.__getstate__(self)
+        columns = {}
+        for attribute, column in self.__columns.iteritems():
+            if isinstance(column, array.array):
+                columns[attribute] = (column.typecode, column.tostring())
+            else:
+                columns[attribute] = (None, column)
+        state["_ColumnarTable__columns"] = columns
+        return state
+
+    def __setstate__(self, state):
+        Table.__setstate__(self, state)
+        columns = {}
+        for attribute, (typecode, data) in self.__columns.iteritems():
+            if typecode:
+                columns[attribute] = array.array(typecode)
+                columns[attribute].fromstring(data)
+            else:
+                columns[attribute] = data
+        self.__columns = columns
+        self.__positions = dict(itertools.izip(self.__ids, itertools.count()))
+
+    def __copy__(self):
+        # The columns are shared, see snapshot()
+        new = self.__class__.__new__(self.__class__)
+        new.__dict__.update(self.__dict__)
+        for k in Table._transientAttributes:
+            new.__dict__.pop(k, None)
+        return new
+
+    def snapshot(self):
+        snapshot = Table.snapshot(self)
+        snapshot.__ids = list(self.__ids)
+        snapshot.__positions = self.__positions.copy()
+        snapshot.__columns = dict((attribute, column[:])
+                                  for attribute, column in self.__columns.iteritems())
+        snapshot.__extras = list(self.__extras)
+        return snapshot
+
+    @staticmethod
+    def __getAttributes(model):
+        if hasattr(model, "__getstate__"):
+            return model.__getstate__()
+        return model.__dict__
+
+    def __materialize(self, pos, getCopy=False):
+        state = {}
+        if self.__extras[pos]:
+            state.update(self.__extras[pos])
+        for attribute, column in self.__columns.iteritems():
+            if not isinstance(column, array.array):
+                state[attribute] = column[pos]
+        if getCopy:
+            # Array values are immutable
+            state = copy.deepcopy(state)
+        for attribute, column in self.__columns.iteritems():
+            if isinstance(column, array.array):
+                state[attribute] = column[pos]
+        model = self.modelClass.__new__(self.modelClass)
+        model.__setstate__(state)
+        return model
+
+    def __setValue(self, attribute, pos, value):
+        column = self.__columns[attribute]
+        try:
+            if pos < len(column):
+                column[pos] = value
+            else:
+                column.append(value)
+        except (TypeError, OverflowError):
+            self.logger.info("Column %r of table %r cannot hold %r, storing it as a list",
+                             attribute, self.getTableName(), value)
+            column = self.__columns[attribute] = column.tolist()
+            self.__setValue(attribute, pos, value)
+
+    def __store(self, pos, model):
+        state = self.__getAttributes(model)
+        extras = None
+        for attribute, value in state.iteritems():
+            if attribute not in self.__columns:
+                if extras is None:
+                    extras = {}
+                extras[attribute] = value
+        self.__extras[pos] = extras
+        for attribute in self.__columns:
+            self.__setValue(attribute, pos, state.get(attribute))
+
+    def __set(self, id, model):
+        pos = self.__positions.get(id)
+        if pos is None:
+            pos = len(self.__ids)
+            self.__ids.append(id)
+            self.__positions[id] = pos
+            self.__extras.append(None)
+        elif self._isIndexed():
+            self._unindex(id, self.__materialize(pos))
+        self.__store(pos, model)
+        self._index(id, model)
+
+    def __update(self, id, model, createIfNotFound=False):
+        pos = self.__positions.get(id)
+        if pos is None:
+            if not createIfNotFound:
+                raise KeyError("Table '%s' has no key '%s'" % (self.getTableName(), id))
+            self.__set(id, model)
+            return
+        element = self.__materialize(pos)
+        self._unindex(id, element)
+        element.update(model)
+        self.__store(pos, element)
+        self._index(id, element)
+
+    def __delete(self, id):
+        pos = self.__positions.get(id)
+        if pos is None:
+            raise KeyError("Table '%s' has no key '%s'" % (self.getTableName(), id))
+        if self._isIndexed():
+            self._unindex(id, self.__materialize(pos))
+        # Move the last record into the hole
+        del self.__positions[id]
+        last = len(self.__ids) - 1
+        if pos != last:
+            lastId = self.__ids[last]
+            self.__ids[pos] = lastId
+            self.__positions[lastId] = pos
+            self.__extras[pos] = self.__extras[last]
+            for column in self.__columns.itervalues():
+                column[pos] = column[last]
+        self.__ids.pop()
+        self.__extras.pop()
+        for column in self.__columns.itervalues():
+            column.pop()
+
+    def get(self, id, default=None, getCopy=True):
+        pos = self.__positions.get(id)
+        if pos is None:
+            return default
+        return self.__materialize(pos, getCopy)
+
+    def getAll(self, getCopy=True):
+        return dict(self.iteritems(getCopy))
+
+    def iteritems(self, getCopy=True):
+        for id in list(self.__ids):
+            pos = self.__positions.get(id)
+            if pos is not None:
+                yield id, self.__materialize(pos, getCopy)
+
+    def iterkeys(self, getCopy=True):
+        return iter(list(self.__ids))
+
+    def itervalues(self, getCopy=True):
+        for id, element in self.iteritems(getCopy):
+            yield element
+
+    def iterColumn(self, attribute):
+        # Yields (id, value) pairs without creating models
+        return itertools.izip(list(self.__ids), self.__columns[attribute][:])
 
     def set(self, id, model):
         if id is __builtin__.id:
             raise IdError("Tried to set model with builtin function id as key")
-        self.__getTable()[id] = model
+        self.__set(id, model)
+        self._recordChange("set", id, model)
 
     def update(self, id, model, createIfNotFound=False):
         if id is __builtin__.id:
             raise IdError("Tried to update model with builtin function id as key")
-        element = self.__getTable().get(id)
-        if element:
-            element.update(model)
-        elif createIfNotFound:
-            self.__getTable()[id] = model
-        else:
-            raise KeyError("Table '%s' has no key '%s'" % (self.__tableName, id))
+        self.__update(id, model, createIfNotFound)
+        self._recordChange("update", id, model, createIfNotFound)
 
     def delete(self, id):
         if id is __builtin__.id:
             raise IdError("Tried to delete model with builtin function id as key")
-        if self.__getTable().get(id):
-            del self.__getTable()[id]
-        else:
-            raise KeyError("Table '%s' has no key '%s'" % (self.__tableName, id))
+        self.__delete(id)
+        self._recordChange("delete", id)
 
     def clear(self):
-        table = self.__getTable()
-        table.clear()
+        self.__clearColumns()
+        Table.clear(self)
 
-    def __repr__(self):
-        output = self.__class__.__name__ + "{"
+    def _applyOperations(self, operations):
+        previous = {}
+        try:
+            for op, args in operations:
+                id = args[0]
+                if id is __builtin__.id:
+                    raise IdError("Tried to %s model with builtin function id as key" % op)
+                if id not in previous:
+                    previous[id] = self.get(id, getCopy=True)
+                if op == "set":
+                    self.__set(*args)
+                elif op == "update":
+                    self.__update(*args)
+                elif op == "delete":
+                    self.__delete(id)
+                else:
+                    raise ValueError("Unknown batch operation %r" % op)
+        except:
+            self._rollbackOperations(previous)
+            raise
+        return previous
 
-        members = []
-        for k, v in self.__dict__.iteritems():
-            if k in ["_Table__database", "logger"]:
-                continue
-            members.append("%s: %r" % (k, v))
+    def _rollbackOperations(self, previous):
+        for id, element in previous.iteritems():
+            if element is not None:
+                self.__set(id, element)
+            elif id in self.__positions:
+                self.__delete(id)
 
-        output += ", ".join(members) + "}"
-        return output
+    def __isIndexed(self, attribute):
+        for index in self._getIndexDefinitions():
+            if index.attribute == attribute:
+                return True
+        return False
+
+    def __getRows(self, positions, getCopy):
+        return [(self.__ids[pos], self.__materialize(pos, getCopy)) for pos in positions]
+
+    def filter(self, attribute, predicate, getCopy=True):
+        # Returns a list of (id, model) pairs for which predicate
+        # returns true for the value of attribute
+        column = self.__columns[attribute]
+        selected = itertools.compress(itertools.count(), itertools.imap(predicate, column))
+        return self.__getRows(list(selected), getCopy)
+
+    def find(self, attribute, value, getCopy=True):
+        # Scans the column unless the attribute is indexed
+        column = self.__columns.get(attribute)
+        if column is None or self.__isIndexed(attribute):
+            return Table.find(self, attribute, value, getCopy)
+        selected = itertools.compress(itertools.count(),
+                                      itertools.imap(functools.partial(operator.eq, value),
+                                                     column))
+        return self.__getRows(list(selected), getCopy)
+
+    def findRange(self, attribute, low=None, high=None, reverse=False, limit=None, offset=0,
+                  getCopy=True):
+        # Sorts the matching positions of the column unless the
+        # attribute is indexed
+        column = self.__columns.get(attribute)
+        if column is None or self.__isIndexed(attribute):
+            return Table.findRange(self, attribute, low, high, reverse, limit, offset, getCopy)
+        selectors = []
+        if low is not None:
+            selectors.append(itertools.imap(functools.partial(operator.le, low), column))
+        if high is not None:
+            selectors.append(itertools.imap(functools.partial(operator.ge, high), column))
+        if len(selectors) == 2:
+            selectors = [itertools.imap(operator.and_, *selectors)]
+        if selectors:
+            positions = list(itertools.compress(itertools.count(), selectors[0]))
+        else:
+            positions = range(len(column))
+        positions.sort(key=column.__getitem__, reverse=reverse)
+        if limit is None:
+            positions = positions[offset:]
+        else:
+            positions = positions[offset:offset + limit]
+        return self.__getRows(positions, getCopy)
+
+def _decodeJsonTable(item):
+    # Runs in the worker processes of Database._loadJson(). Decoding the
+    # text pickle of a table and encoding it again as a binary pickle
+    # leaves the parent with a much cheaper pickle to load.
+    tableName, b64PickledTable = item
+    table = pickle.loads(base64.b64decode(b64PickledTable))
+    return tableName, pickle.dumps(table, pickle.HIGHEST_PROTOCOL)
 
 class Database(object):
     logger = None
     preferJson = False
+    preferContainer = False
+    # Number of processes decoding the tables of a JSON database in
+    # parallel when loading it (0 = no separate processes)
+    loadProcesses = 0
+    # Codec compressing the pickle and JSON files (see
+    # Compression.codecs, None = uncompressed), and its level
+    compression = None
+    compressionLevel = 6
+    _journalSequence = 0
+    __journal = None
+    __generationFile = None
+    __encodedTables = None
+    __savedPickleState = None
+    __savedJsonState = None
+    __savedContainerState = None
+    __fileDescriptions = None
+    __savedManifest = None
+    __backgroundSave = None
+    __queuedSaves = None
+    # Number of _saveSnapshot() calls on this object. Background saves
+    # call it on a snapshot, so only foreground saves are counted.
+    __snapshotsSaved = 0
+
+    _saveCacheAttributes = ["_Database__encodedTables",
+                            "_Database__savedPickleState",
+                            "_Database__savedJsonState",
+                            "_Database__savedContainerState",
+                            "_Database__fileDescriptions",
+                            "_Database__savedManifest"]
+    _transientAttributes = ["_Database__journal",
+                            "_Database__generationFile",
+                            "_Database__backgroundSave",
+                            "_Database__queuedSaves",
+                            "_Database__snapshotsSaved"] + _saveCacheAttributes
 
     def __init__(self):
         if not self.__class__.logger:
             self.__class__.logger = util.getLogger(self)
 
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        for k in self._transientAttributes:
+            state.pop(k, None)
+        return state
+
     def __setstate__(self, state):
         if not self.__class__.logger:
             self.__class__.logger = util.getLogger(self)
@@ -158,25 +1681,185 @@ class Database(object):
         jsonName = ".".join([base, "json"])
         return os.path.join(path, jsonName)
 
+    @staticmethod
+    def _computeContainerFilename(filename):
+        path, name = os.path.split(filename)
+        base, ext = os.path.splitext(name)
+        containerName = ".".join([base, "gdb"])
+        return os.path.join(path, containerName)
+
+    @staticmethod
+    def _computeJournalFilename(filename):
+        path, name = os.path.split(filename)
+        base, ext = os.path.splitext(name)
+        journalName = ".".join([base, "journal"])
+        return os.path.join(path, journalName)
+
+    @staticmethod
+    def _computeGenerationFilename(filename):
+        path, name = os.path.split(filename)
+        base, ext = os.path.splitext(name)
+        generationName = ".".join([base, "generation"])
+        return os.path.join(path, generationName)
+
+    @staticmethod
+    def _computeManifestFilename(filename):
+        path, name = os.path.split(filename)
+        base, ext = os.path.splitext(name)
+        manifestName = ".".join([base, "manifest"])
+        return os.path.join(path, manifestName)
+
+    def _iterTables(self):
+        for tableName, table in self.__dict__.items():
+            if isinstance(table, Table):
+                yield tableName, table
+
+    def enableJournal(self, filename):
+        self.logger.debug("enableJournal(%r)", filename)
+        self.disableJournal()
+        self.__journal = Journal(self._computeJournalFilename(filename),
+                                 self._journalSequence)
+        for tableName, table in self._iterTables():
+            table.setJournal(self.__journal, tableName)
+        # Readers in other processes reload the database when the
+        # checkpoint count changes, e.g. when the writer restarts
+        self.__generationFile = GenerationFile(self._computeGenerationFilename(filename),
+                                               writable=True)
+        self.__publish(checkpoint=True)
+
+    def disableJournal(self):
+        if self.__journal:
+            for tableName, table in self._iterTables():
+                table.setJournal(None)
+            self.__journal.close()
+            self.__journal = None
+        if self.__generationFile:
+            self.__generationFile.close()
+            self.__generationFile = None
+
+    def __publish(self, checkpoint=False):
+        # Tells readers (see DatabaseReader) about the synced changes
+        if self.__generationFile and self.__journal:
+            checkpoints, sequence = self.__generationFile.read()
+            if checkpoint:
+                checkpoints += 1
+            self.__generationFile.write(checkpoints, self.__journal.sequence)
+
+    def isJournalEnabled(self):
+        return self.__journal is not None
+
+    def transaction(self):
+        # Usage:
+        #     with database.transaction() as transaction:
+        #         transaction.batch(database.users).set(id, model)
+        #         transaction.batch(database.groups).delete(groupId)
+        #         ...
+        return Transaction(self)
+
+    def applyTransaction(self, batches):
+        # Atomically applies batches of operations on several tables,
+        # journaled as a single record
+        applied = []
+        try:
+            for batch in batches:
+                applied.append((batch.table, batch.table._applyOperations(batch.operations)))
+        except:
+            for table, undo in reversed(applied):
+                table._rollbackOperations(undo)
+            raise
+
+        tableNames = dict((id(table), tableName) for tableName, table in self._iterTables())
+        records = []
+        for batch in batches:
+            batch.table.markDirty()
+            tableName = tableNames.get(id(batch.table))
+            if tableName:
+                records.append((tableName, batch.operations))
+        if self.__journal and records:
+            self.__journal.append(None, "transaction", records)
+
+    def sync(self):
+        if self.__journal:
+            self.__journal.flush()
+            self.__publish()
+
+    def _replayJournal(self, journalPath):
+        self.logger.info("Replaying journal %r from sequence %d",
+                         journalPath, self._journalSequence)
+        replayed = 0
+        for record in Journal.readRecords(journalPath):
+            if self._applyJournalRecord(*record):
+                replayed += 1
+        self.logger.info("Replayed %d journal records", replayed)
+
+    def _applyJournalRecord(self, sequence, tableName, op, args):
+        if sequence <= self._journalSequence:
+            # Already part of the snapshot
+            return False
+        if tableName is None and op == "transaction":
+            for tableName, operations in args:
+                self._replayJournalRecord(sequence, tableName, "applyBatch", (operations,))
+        else:
+            self._replayJournalRecord(sequence, tableName, op, args)
+        self._journalSequence = sequence
+        return True
+
+    def _replayJournalRecord(self, sequence, tableName, op, args):
+        table = getattr(self, tableName, None)
+        if not isinstance(table, Table):
+            self.logger.warning("Journal record for unknown table %r, ignoring", tableName)
+            return
+        try:
+            table._replayJournalRecord(op, args)
+        except (KeyError, IdError), e:
+            # The snapshot already differs from what the record expects,
+            # e.g. a key deleted by the record is missing. Skipping it
+            # keeps the rest of the database loadable.
+            self.logger.warning("Skipping journal record %d (%s on table %r) that "
+                                "does not apply: %s", sequence, op, tableName, e)
+
     @classmethod
     def _loadJson(cls, filename):
-        jsonFh = open(filename, "r")
+        jsonFh = Compression.open(filename)
         jsonDb = json.load(jsonFh)
         jsonFh.close()
         db = cls()
         backRefTables = []
-        for tableName, b64PickledTable in jsonDb.iteritems():
-            pickledTable = base64.b64decode(b64PickledTable)
-            table = pickle.loads(pickledTable)
-            if tableName == "_backRefTables":
-                backRefTables = table
-                continue
-            setattr(db, tableName, table)
+        # The garbage collector would otherwise traverse the growing
+        # tables over and over while they are unpickled. Worker
+        # processes inherit this setting.
+        gcEnabled = gc.isenabled()
+        gc.disable()
+        pool = None
+        try:
+            if cls.loadProcesses > 1 and len(jsonDb) > 3:
+                import multiprocessing
+                pool = multiprocessing.Pool(min(cls.loadProcesses, len(jsonDb)))
+                pickledTables = pool.imap_unordered(_decodeJsonTable, jsonDb.iteritems())
+            else:
+                pickledTables = ((tableName, base64.b64decode(b64PickledTable))
+                                 for tableName, b64PickledTable in jsonDb.iteritems())
+
+            for tableName, pickledTable in pickledTables:
+                table = pickle.loads(pickledTable)
+                if tableName == "_backRefTables":
+                    backRefTables = table
+                    continue
+                if tableName == "_journalSequence":
+                    db._journalSequence = table
+                    continue
+                setattr(db, tableName, table)
+        finally:
+            if gcEnabled:
+                gc.enable()
+            if pool:
+                pool.close()
+                pool.join()
 
         for tableName in backRefTables:
             getattr(db, tableName).setDatabase(db)
 
-        for tableName, table in db.__dict__.iteritems():
+        for tableName, table in db._iterTables():
             table = cls._loadJsonTableTransform(db, tableName, table)
             setattr(db, tableName, table)
 
@@ -186,9 +1869,42 @@ class Database(object):
     def _loadJsonTableTransform(cls, database, tableName, table):
         return table
 
+    @classmethod
+    def _loadContainer(cls, filename):
+        db = cls()
+        backRefTables = []
+        rawSections = {}
+        f = open(filename, "rb")
+        try:
+            for tableName, table in TableContainer.read(f):
+                if isinstance(table, RawSection):
+                    rawSections[tableName] = table
+                elif tableName == "_backRefTables":
+                    backRefTables = table
+                elif tableName == "_journalSequence":
+                    db._journalSequence = table
+                else:
+                    setattr(db, tableName, table)
+        finally:
+            f.close()
+
+        for tableName in backRefTables:
+            getattr(db, tableName).setDatabase(db)
+
+        for tableName, table in db._iterTables():
+            if hasattr(table, "_attachContainer"):
+                table._attachContainer(rawSections)
+
+        # The per-table hooks of the JSON format apply to containers too
+        for tableName, table in db._iterTables():
+            table = cls._loadJsonTableTransform(db, tableName, table)
+            setattr(db, tableName, table)
+
+        return db
+
     @classmethod
     def _loadPickle(cls, filename):
-        f = open(filename, "r")
+        f = Compression.open(filename)
         o = pickle.load(f)
         f.close()
         if hasattr(o, "_loadPickleTransform"):
@@ -198,25 +1914,58 @@ class Database(object):
     def _loadPickleTransform(self):
         pass
 
+    @classmethod
+    def exists(cls, filename):
+        return os.path.exists(filename) \
+            or os.path.exists(cls._computeJsonFilename(filename)) \
+            or os.path.exists(cls._computeContainerFilename(filename)) \
+            or os.path.exists(cls._computeJournalFilename(filename))
+
     @classmethod
     def load(cls, filename):
         if not cls.logger:
             cls.logger = util.getLogger(cls)
         jsonPath = cls._computeJsonFilename(filename)
-        if cls.preferJson and os.path.exists(jsonPath):
-            return cls._loadJson(jsonPath)
-        else:
-            return cls._loadPickle(filename)
+        containerPath = cls._computeContainerFilename(filename)
+        candidates = []
+        if cls.preferContainer:
+            candidates.append((containerPath, cls._loadContainer))
+        if cls.preferJson:
+            candidates.append((jsonPath, cls._loadJson))
+        candidates += [(filename, cls._loadPickle),
+                       (jsonPath, cls._loadJson),
+                       (containerPath, cls._loadContainer)]
+        candidates = [(path, loader) for path, loader in candidates if os.path.exists(path)]
 
-    def _saveJson(self, filename):
-        self.logger.debug("_saveJson(%r)", filename)
-        jsonPath = self._computeJsonFilename(filename)
-        tmpJsonPath = "%s.new" % jsonPath
+        # Only load a file of the snapshot named by the manifest, unless
+        # the save was interrupted before the manifest was written
+        manifest = cls._loadManifest(filename)
+        if manifest and candidates:
+            current = next(((path, loader) for path, loader in candidates
+                            if cls._matchesManifest(manifest, path)), None)
+            if current:
+                candidates = [current]
+            else:
+                cls.logger.warning("No database file matches manifest generation %d, "
+                                   "loading %r", manifest.get("generation", 0),
+                                   candidates[0][0])
+
+        if candidates:
+            path, loader = candidates[0]
+            db = loader(path)
+        else:
+            cls.logger.info("No database snapshot %r found, starting empty", filename)
+            db = cls()
+        journalPath = cls._computeJournalFilename(filename)
+        for path in [Journal.rotatedFilename(journalPath), journalPath]:
+            if os.path.exists(path):
+                db._replayJournal(path)
+        return db
 
+    def _getDetachedTables(self):
         tables = {}
-        for tableName, table in self.__dict__.iteritems():
-            if isinstance(table, Table):
-                tables[tableName] = copy.copy(table)
+        for tableName, table in self._iterTables():
+            tables[tableName] = copy.copy(table)
 
         backRefTables = []
         for tableName, table in tables.iteritems():
@@ -226,54 +1975,840 @@ class Database(object):
                 backRefTables.append(tableName)
                 table.setDatabase(None)
         tables["_backRefTables"] = backRefTables
+        tables["_journalSequence"] = self._journalSequence
+        return tables
+
+    def _saveJson(self, filename):
+        self.logger.debug("_saveJson(%r)", filename)
+        jsonPath = self._computeJsonFilename(filename)
+        tmpJsonPath = "%s.new" % jsonPath
+        saveState = self._getSaveState(jsonPath)
+        if saveState == self.__savedJsonState and os.path.exists(jsonPath):
+            self.logger.debug("Database unchanged since last save, skipping")
+            return True
 
+        tables = self._getDetachedTables()
+
+        previousEncodedTables = self.__encodedTables or {}
+        encodedTables = {}
         db = {}
         for tableName, table in tables.iteritems():
-            table = self._saveJsonTableTransform(tableName, table)
-            pickledTable = pickle.dumps(table)
-            b64PickledTable = base64.b64encode(pickledTable)
+            original = getattr(self, tableName, None)
+            if isinstance(original, Table):
+                source = original._getSource()
+                generation = original.getGeneration()
+                cached = previousEncodedTables.get(tableName)
+                if cached and cached[0] is source and cached[1] == generation:
+                    self.logger.debug("Table %s unchanged, reusing encoded table", tableName)
+                    b64PickledTable = cached[2]
+                else:
+                    b64PickledTable = self._encodeJsonTable(tableName, table)
+                encodedTables[tableName] = (source, generation, b64PickledTable)
+            else:
+                b64PickledTable = self._encodeJsonTable(tableName, table)
             db[tableName] = b64PickledTable
 
         try:
-            f = open(tmpJsonPath, "w")
-            json.dump(db, f)
-            f.close()
+            f = open(tmpJsonPath, "wb")
+            checksum = ChecksumWriter(f)
+            writer = self._openSnapshotWriter(checksum)
+            json.dump(db, writer)
+            self._finishSnapshotWriter(f, writer)
             os.rename(tmpJsonPath, jsonPath)
+            syncDirectory(jsonPath)
+            self.__encodedTables = encodedTables
+            self.__savedJsonState = saveState
+            self.__describeSavedFile(jsonPath, checksum)
+            return True
         except:
             self.logger.exception("Could not save JSON database")
             os.unlink(tmpJsonPath)
+            return False
+
+    def _encodeJsonTable(self, tableName, table):
+        table = self._saveJsonTableTransform(tableName, table)
+        pickledTable = pickle.dumps(table)
+        return base64.b64encode(pickledTable)
 
     @classmethod
     def _saveJsonTableTransform(cls, tableName, table):
         return table
 
+    def _getSaveState(self, filename):
+        tables = []
+        other = {}
+        for k, v in self.__getstate__().iteritems():
+            if isinstance(v, Table):
+                tables.append((k, v._getSource(), v.getGeneration()))
+            else:
+                other[k] = v
+        return (filename, self.compression, self.compressionLevel,
+                sorted(tables), pickle.dumps(other))
+
+    def _openSnapshotWriter(self, f):
+        if self.compression:
+            return Compression.writer(f, self.compression, self.compressionLevel)
+        return f
+
+    def _finishSnapshotWriter(self, f, writer):
+        if isinstance(writer, CompressedWriter):
+            writer.finish()
+        f.flush()
+        os.fsync(f.fileno())
+        f.close()
+
     def _savePickle(self, filename):
         self.logger.debug("_savePickle(%r)", filename)
         self._savePickleTransform()
+        saveState = self._getSaveState(filename)
+        if saveState == self.__savedPickleState and os.path.exists(filename):
+            self.logger.debug("Database unchanged since last save, skipping")
+            return True
         tmpFilename = "%s.new" % filename
         try:
-            f = open(tmpFilename, "w")
-            pickle.dump(self, f)
-            f.close()
+            f = open(tmpFilename, "wb")
+            checksum = ChecksumWriter(f)
+            writer = self._openSnapshotWriter(checksum)
+            pickle.dump(self, writer)
+            self._finishSnapshotWriter(f, writer)
             os.rename(tmpFilename, filename)
+            syncDirectory(filename)
+            self.__savedPickleState = saveState
+            self.__describeSavedFile(filename, checksum)
+            return True
         except:
             self.logger.exception("Could not save database")
             os.unlink(tmpFilename)
+            return False
 
     def _savePickleTransform(self):
         self.logger.debug("_savePickleTransform()")
 
+    def _saveContainer(self, filename):
+        self.logger.debug("_saveContainer(%r)", filename)
+        containerPath = self._computeContainerFilename(filename)
+        saveState = self._getSaveState(containerPath)
+        if saveState == self.__savedContainerState and os.path.exists(containerPath):
+            self.logger.debug("Database unchanged since last save, skipping")
+            return True
+
+        def sections():
+            # Detach and transform one table at a time while writing
+            tables = self._getDetachedTables()
+            for tableName in sorted(tables.keys()):
+                table = self._saveJsonTableTransform(tableName, tables.pop(tableName))
+                if hasattr(table, "_getContainerSections"):
+                    for section in table._getContainerSections(tableName):
+                        yield section
+                else:
+                    yield tableName, table
+
+        tmpContainerPath = "%s.new" % containerPath
+        try:
+            f = open(tmpContainerPath, "wb")
+            checksum = ChecksumWriter(f)
+            TableContainer.write(checksum, sections())
+            f.flush()
+            os.fsync(f.fileno())
+            f.close()
+            os.rename(tmpContainerPath, containerPath)
+            syncDirectory(containerPath)
+            self.__savedContainerState = saveState
+            self.__describeSavedFile(containerPath, checksum)
+            return True
+        except:
+            self.logger.exception("Could not save database container")
+            os.unlink(tmpContainerPath)
+            return False
+
     def save(self, filename):
         self.logger.debug("save(%r)", filename)
-        self._savePickle(filename)
-        self._saveJson(filename)
-        
+        if self.__journal:
+            # The snapshot contains the journaled changes, so the
+            # journal has to be rotated along with it
+            return self.checkpoint(filename)
+        self._waitForBackgroundSave()
+        return self._saveSnapshot(filename)
+
+    def _saveSnapshot(self, filename):
+        try:
+            return self.__saveSnapshot(filename)
+        finally:
+            self.__snapshotsSaved += 1
+
+    def __saveSnapshot(self, filename):
+        if self.preferContainer:
+            results = [(self._saveContainer(filename), self._computeContainerFilename(filename))]
+        else:
+            results = [(self._savePickle(filename), filename),
+                       (self._saveJson(filename), self._computeJsonFilename(filename))]
+        paths = [path for saved, path in results if saved]
+        if not paths or not self._saveManifest(filename, paths):
+            return False
+        return len(paths) == len(results)
+
+    @classmethod
+    def _loadManifest(cls, filename):
+        manifestPath = cls._computeManifestFilename(filename)
+        if not os.path.exists(manifestPath):
+            return None
+        try:
+            f = open(manifestPath, "r")
+            try:
+                return json.load(f)
+            finally:
+                f.close()
+        except ValueError:
+            cls.logger.warning("Ignoring unreadable manifest %r", manifestPath)
+            return None
+
+    @staticmethod
+    def _matchesManifest(manifest, path):
+        # Compares the size, inode and modification time recorded in
+        # the manifest, which is enough to tell a file renamed into
+        # place by a later save, without reading it
+        entry = manifest.get("files", {}).get(os.path.basename(path))
+        st = os.stat(path)
+        if not entry or entry[0] != st.st_size:
+            return False
+        if len(entry) < 4:
+            # Manifest from an older version, without inode and time
+            return describeFile(path) == entry
+        return entry[2:] == [st.st_ino, st.st_mtime]
+
+    def __describeSavedFile(self, path, checksum):
+        # Manifest entry of a file just written through checksum: size,
+        # CRC-32 (see describeFile), inode and modification time
+        description = (checksum and checksum.describe()) or describeFile(path)
+        st = os.stat(path)
+        descriptions = dict(self.__fileDescriptions or {})
+        descriptions[os.path.basename(path)] = description + [st.st_ino, st.st_mtime]
+        self.__fileDescriptions = descriptions
+
+    def _saveManifest(self, filename, paths):
+        # The manifest is written last, once all files of the snapshot
+        # are on disk, and names the files that belong together
+        self.logger.debug("_saveManifest(%r, %r)", filename, paths)
+        files = {}
+        for path in paths:
+            name = os.path.basename(path)
+            if name not in (self.__fileDescriptions or {}):
+                # Not written by this process
+                self.__describeSavedFile(path, None)
+            files[name] = self.__fileDescriptions[name]
+        if (files, self._journalSequence) == self.__savedManifest:
+            self.logger.debug("Manifest unchanged since last save, skipping")
+            return True
+        manifestPath = self._computeManifestFilename(filename)
+        tmpManifestPath = "%s.new" % manifestPath
+        previous = self._loadManifest(filename) or {}
+        manifest = {"generation": previous.get("generation", 0) + 1,
+                    "journalSequence": self._journalSequence,
+                    "files": files}
+        try:
+            f = open(tmpManifestPath, "w")
+            json.dump(manifest, f)
+            f.flush()
+            os.fsync(f.fileno())
+            f.close()
+            os.rename(tmpManifestPath, manifestPath)
+            syncDirectory(manifestPath)
+            self.__savedManifest = (files, self._journalSequence)
+            return True
+        except:
+            self.logger.exception("Could not save database manifest")
+            if os.path.exists(tmpManifestPath):
+                os.unlink(tmpManifestPath)
+            return False
+
+    def checkpoint(self, filename):
+        self.logger.debug("checkpoint(%r)", filename)
+        if not self.__journal:
+            return self.save(filename)
+        self._waitForBackgroundSave()
+        rotated = self.__rotateJournal()
+        if self._saveSnapshot(filename):
+            # Only forget the journal once the snapshot is safely on disk
+            os.unlink(rotated)
+            self.__publish(checkpoint=True)
+            return True
+        return False
+
+    def __rotateJournal(self):
+        self.__journal.flush()
+        self._journalSequence = self.__journal.sequence
+        return self.__journal.rotate()
+
+    def snapshot(self):
+        snapshot = copy.copy(self)
+        for tableName, table in self._iterTables():
+            tableSnapshot = table.snapshot()
+            if table.getDatabase() is self:
+                tableSnapshot.setDatabase(snapshot)
+            setattr(snapshot, tableName, tableSnapshot)
+        for k in self._saveCacheAttributes:
+            setattr(snapshot, k, getattr(self, k))
+        return snapshot
+
+    def releaseSnapshot(self):
+        for tableName, table in self._iterTables():
+            table.releaseSnapshot()
+
+    def checkpointInThread(self, filename):
+        # Same as checkpoint(), but the snapshot is serialized in a
+        # thread. Returns a Deferred firing with the result. Requests
+        # made while a save is running are coalesced into one
+        # following save.
+        from twisted.internet import defer
+        d = defer.Deferred()
+        if self.__backgroundSave:
+            self.logger.debug("Background save in progress, queueing")
+            self.__queuedSaves = (self.__queuedSaves or []) + [d]
+        else:
+            self.__startBackgroundSave(filename, [d])
+        return d
+
+    def __startBackgroundSave(self, filename, deferreds):
+        self.logger.debug("__startBackgroundSave(%r)", filename)
+        from twisted.internet import threads
+        from twisted.python import failure
+        import threading
+
+        rotated = None
+        if self.__journal:
+            rotated = self.__rotateJournal()
+        snapshot = self.snapshot()
+        snapshotsSaved = self.__snapshotsSaved
+        done = threading.Event()
+        self.__backgroundSave = done
+
+        def save():
+            try:
+                saved = snapshot._saveSnapshot(filename)
+                if saved and rotated:
+                    os.unlink(rotated)
+                return saved
+            finally:
+                done.set()
+
+        def finished(result):
+            self.__backgroundSave = None
+            snapshot.releaseSnapshot()
+            if result is True:
+                # The caches of a foreground save made after the
+                # snapshot was taken are newer
+                if self.__snapshotsSaved == snapshotsSaved:
+                    for k in self._saveCacheAttributes:
+                        setattr(self, k, getattr(snapshot, k))
+                # The journal may have been disabled in the meantime
+                if rotated and self.__journal:
+                    self.__journal.flush()
+                    self.__publish(checkpoint=True)
+            queued, self.__queuedSaves = self.__queuedSaves, None
+            if queued:
+                self.__startBackgroundSave(filename, queued)
+            for d in deferreds:
+                if isinstance(result, failure.Failure):
+                    d.errback(result)
+                else:
+                    d.callback(result)
+
+        threads.deferToThread(save).addBoth(finished)
+
+    def _waitForBackgroundSave(self):
+        if self.__backgroundSave and not self.__backgroundSave.is_set():
+            self.logger.info("Waiting for background save to finish")
+            self.__backgroundSave.wait()
+
     def __repr__(self):
         output = self.__class__.__name__ + "{"
 
         members = []
         for k, v in self.__dict__.iteritems():
+            if k in self._transientAttributes:
+                continue
             members.append("%s: %r" % (k, v))
 
         output += ", ".join(members) + "}"
         return output
+
+class SqliteTable(Table):
+    # Table whose rows are stored in the SQLite file of a
+    # SqliteDatabase instead of in memory. Every change is committed
+    # right away, except in batches and transactions, which are
+    # committed once. Models are decoded on every read, so a model
+    # fetched with getCopy=False must be written back with set() or
+    # update() after modifying it. Indexed attributes (see
+    # tableIndexes) are stored in indexed columns, which find(),
+    # findRange() and orderBy() query directly. The table is attached
+    # to the SQLite file when it is created with the database as
+    # argument, or assigned to an attribute of the database.
+    __connection = None
+    __sql = None
+    __columns = None
+    __columnIndexes = None
+    _batchSize = 1000
+
+    _transientAttributes = Table._transientAttributes + ["_SqliteTable__connection",
+                                                         "_SqliteTable__sql",
+                                                         "_SqliteTable__columns",
+                                                         "_SqliteTable__columnIndexes"]
+
+    def __init__(self, tableName, database=None, deepCopy=True):
+        Table.__init__(self, tableName, database, deepCopy)
+        if database and hasattr(database, "getConnection"):
+            self._attach(database.getConnection())
+
+    def __getstate__(self):
+        state = Table.__getstate__(self)
+        state[self.getTableName()] = {}
+        return state
+
+    def __getConnection(self):
+        if self.__connection is None:
+            raise DetachedTableError("SqliteTable '%s' is not attached to a SqliteDatabase"
+                                     % self.getTableName())
+        return self.__connection
+
+    def _isAttached(self):
+        return self.__connection is not None
+
+    @staticmethod
+    def __quote(name):
+        return '"%s"' % name.replace('"', '""')
+
+    def _attach(self, connection):
+        self.__connection = connection
+        self.__columns = {}
+        self.__columnIndexes = []
+        connection.execute("CREATE TABLE IF NOT EXISTS %s (id PRIMARY KEY, data BLOB)" %
+                           self.__quote(self.getTableName()))
+        self.__prepare()
+        for index in self._getIndexDefinitions():
+            self.__addColumn(index)
+        self.__prepare()
+
+    def __prepare(self):
+        # The sqlite3 module caches prepared statements by their text
+        table = self.__quote(self.getTableName())
+        columns = ["id", "data"] + [self.__columns[index.attribute]
+                                    for index in self.__columnIndexes]
+        self.__sql = {
+            "get": "SELECT data FROM %s WHERE id = ?" % table,
+            # Rows are updated in place, keeping their rowid, so that
+            # iteration (by rowid) is not disturbed by updates
+            "update": "UPDATE %s SET %s WHERE id = ?" % (
+                table, ", ".join("%s = ?" % column for column in columns[1:])),
+            "insert": "INSERT INTO %s (%s) VALUES (%s)" % (
+                table, ", ".join(columns), ", ".join(["?"] * len(columns))),
+            "delete": "DELETE FROM %s WHERE id = ?" % table,
+            "clear": "DELETE FROM %s" % table,
+            "items": "SELECT rowid, id, data FROM %s WHERE rowid > ? ORDER BY rowid LIMIT ?" %
+                     table,
+            "keys": "SELECT rowid, id FROM %s WHERE rowid > ? ORDER BY rowid LIMIT ?" % table,
+        }
+
+    def __addColumn(self, index):
+        if index.attribute in self.__columns:
+            return
+        table = self.__quote(self.getTableName())
+        column = self.__quote("a_%s" % index.attribute)
+        existing = [row[1] for row in self.__getConnection().execute("PRAGMA table_info(%s)" % table)]
+        if "a_%s" % index.attribute not in existing:
+            self.__getConnection().execute("ALTER TABLE %s ADD COLUMN %s" % (table, column))
+            for id, element in self.iteritems():
+                self.__getConnection().execute("UPDATE %s SET %s = ? WHERE id = ?" % (table, column),
+                                          (self.__columnValue(index.getValue(id, element)), id))
+        self.__getConnection().execute("CREATE INDEX IF NOT EXISTS %s ON %s (%s)" % (
+            self.__quote("%s_a_%s" % (self.getTableName(), index.attribute)), table, column))
+        self.__getConnection().commit()
+        self.__columns[index.attribute] = column
+        self.__columnIndexes.append(index)
+
+    @staticmethod
+    def __columnValue(value):
+        if value is None or isinstance(value, (int, long, float, basestring,
+                                                datetime.date, datetime.datetime)):
+            return value
+        # Only equality lookups work for other values
+        return buffer(pickle.dumps(value, pickle.HIGHEST_PROTOCOL))
+
+    def addIndex(self, index):
+        Table.addIndex(self, index)
+        if self.__connection:
+            self.__addColumn(index)
+            self.__prepare()
+
+    def _recordChange(self, op, *args):
+        Table._recordChange(self, op, *args)
+        self.__getConnection().commit()
+
+    def __write(self, id, model):
+        connection = self.__getConnection()
+        values = [buffer(pickle.dumps(model, pickle.HIGHEST_PROTOCOL))]
+        for index in self.__columnIndexes:
+            values.append(self.__columnValue(index.getValue(id, model)))
+        if connection.execute(self.__sql["update"], values + [id]).rowcount == 0:
+            connection.execute(self.__sql["insert"], [id] + values)
+
+    def __update(self, id, model, createIfNotFound=False):
+        element = self.get(id)
+        if element:
+            element.update(model)
+            self.__write(id, element)
+        elif createIfNotFound:
+            self.__write(id, model)
+        else:
+            raise KeyError("Table '%s' has no key '%s'" % (self.getTableName(), id))
+
+    def __delete(self, id):
+        if self.__getConnection().execute(self.__sql["delete"], (id,)).rowcount == 0:
+            raise KeyError("Table '%s' has no key '%s'" % (self.getTableName(), id))
+
+    def get(self, id, default=None, getCopy=True):
+        row = self.__getConnection().execute(self.__sql["get"], (id,)).fetchone()
+        if row is None:
+            return default
+        return pickle.loads(str(row[0]))
+
+    def getAll(self, getCopy=True):
+        return dict(self.iteritems())
+
+    def _copyElement(self, element):
+        # Decoded models are private copies already
+        return element
+
+    def __iterRows(self, sql):
+        # Fetches the rows in chunks by rowid, so that the table can be
+        # modified (and committed) while iterating
+        lastRowId = 0
+        while True:
+            rows = self.__getConnection().execute(self.__sql[sql],
+                                             (lastRowId, self._batchSize)).fetchall()
+            if not rows:
+                break
+            for row in rows:
+                yield row
+            lastRowId = rows[-1][0]
+
+    def iteritems(self, getCopy=True):
+        for rowId, id, data in self.__iterRows("items"):
+            yield id, pickle.loads(str(data))
+
+    def iterkeys(self, getCopy=True):
+        for rowId, id in self.__iterRows("keys"):
+            yield id
+
+    def itervalues(self, getCopy=True):
+        for id, element in self.iteritems():
+            yield element
+
+    def set(self, id, model):
+        if id is __builtin__.id:
+            raise IdError("Tried to set model with builtin function id as key")
+        self.__write(id, model)
+        self._recordChange("set", id, model)
+
+    def update(self, id, model, createIfNotFound=False):
+        if id is __builtin__.id:
+            raise IdError("Tried to update model with builtin function id as key")
+        self.__update(id, model, createIfNotFound)
+        self._recordChange("update", id, model, createIfNotFound)
+
+    def delete(self, id):
+        if id is __builtin__.id:
+            raise IdError("Tried to delete model with builtin function id as key")
+        self.__delete(id)
+        self._recordChange("delete", id)
+
+    def clear(self):
+        self.__getConnection().execute(self.__sql["clear"])
+        self._recordChange("clear")
+
+    def _applyOperations(self, operations):
+        # Nothing is committed until the whole batch has been applied
+        try:
+            for op, args in operations:
+                if args[0] is __builtin__.id:
+                    raise IdError("Tried to %s model with builtin function id as key" % op)
+                if op == "set":
+                    self.__write(*args)
+                elif op == "update":
+                    self.__update(*args)
+                elif op == "delete":
+                    self.__delete(*args)
+                else:
+                    raise ValueError("Unknown batch operation %r" % op)
+        except:
+            self.__getConnection().rollback()
+            raise
+
+    def _rollbackOperations(self, undo):
+        self.__getConnection().rollback()
+
+    def _moveTo(self, connection):
+        # Copies the rows to another database file and uses that from
+        # now on
+        items = list(self.iteritems())
+        self._attach(connection)
+        connection.execute(self.__sql["clear"])
+        for id, element in items:
+            self.__write(id, element)
+
+    def __query(self, sql, params):
+        rows = self.__getConnection().execute(sql, params).fetchall()
+        return [(id, pickle.loads(str(data))) for id, data in rows]
+
+    def find(self, attribute, value, getCopy=True):
+        self.__getConnection()
+        column = self.__columns.get(attribute)
+        if column is None:
+            return [(id, element) for id, element in self.iteritems()
+                    if getattr(element, attribute, None) == value]
+        table = self.__quote(self.getTableName())
+        if value is None:
+            return self.__query("SELECT id, data FROM %s WHERE %s IS NULL ORDER BY rowid" %
+                                (table, column), ())
+        return self.__query("SELECT id, data FROM %s WHERE %s = ? ORDER BY rowid" %
+                            (table, column), (self.__columnValue(value),))
+
+    def findRange(self, attribute, low=None, high=None, reverse=False, limit=None, offset=0,
+                  getCopy=True):
+        self.__getConnection()
+        column = self.__columns.get(attribute)
+        if column is None:
+            index = SortedIndex(attribute)
+            index.build(self.iteritems())
+            return [(id, self.get(id)) for id in index.findRange(low, high, reverse, limit,
+                                                                offset)]
+        clauses = []
+        params = []
+        if low is not None:
+            clauses.append("%s >= ?" % column)
+            params.append(self.__columnValue(low))
+        if high is not None:
+            clauses.append("%s <= ?" % column)
+            params.append(self.__columnValue(high))
+        sql = "SELECT id, data FROM %s" % self.__quote(self.getTableName())
+        if clauses:
+            sql += " WHERE " + " AND ".join(clauses)
+        order = reverse and "DESC" or "ASC"
+        sql += " ORDER BY %s %s, rowid %s LIMIT ? OFFSET ?" % (column, order, order)
+        params.extend([limit is None and -1 or limit, offset])
+        return self.__query(sql, params)
+
+class SqliteDatabase(Database):
+    # Database stored in a SQLite file (<name>.sqlite). The rows of
+    # SqliteTable tables are written to the file as they change, while
+    # other tables and attributes are pickled into it by save(). A new
+    # database is kept in memory until it is saved the first time.
+    # There is no need for a journal.
+    __connection = None
+    __path = None
+
+    _transientAttributes = Database._transientAttributes + ["_SqliteDatabase__connection",
+                                                            "_SqliteDatabase__path"]
+
+    def __init__(self):
+        Database.__init__(self)
+        self.__connect(":memory:")
+
+    def __setattr__(self, name, value):
+        # SqliteTable tables are attached to the database file when
+        # they are assigned
+        if isinstance(value, SqliteTable) and not value._isAttached():
+            value.setDatabase(self)
+            value._attach(self.__connection)
+        Database.__setattr__(self, name, value)
+
+    @staticmethod
+    def _computeSqliteFilename(filename):
+        path, name = os.path.split(filename)
+        base, ext = os.path.splitext(name)
+        sqliteName = ".".join([base, "sqlite"])
+        return os.path.join(path, sqliteName)
+
+    def getConnection(self):
+        return self.__connection
+
+    def __connect(self, path):
+        import sqlite3
+        connection = sqlite3.connect(path)
+        connection.text_factory = str
+        if path != ":memory:":
+            connection.execute("PRAGMA journal_mode=WAL")
+        connection.execute("CREATE TABLE IF NOT EXISTS _guernsey (name TEXT PRIMARY KEY, data BLOB)")
+        connection.commit()
+        self.__connection = connection
+        self.__path = path
+        return connection
+
+    @classmethod
+    def exists(cls, filename):
+        return os.path.exists(cls._computeSqliteFilename(filename))
+
+    @classmethod
+    def load(cls, filename):
+        if not cls.logger:
+            cls.logger = util.getLogger(cls)
+        db = cls()
+        sqlitePath = cls._computeSqliteFilename(filename)
+        if os.path.exists(sqlitePath):
+            db.__open(sqlitePath)
+        else:
+            cls.logger.info("No database %r found, starting empty", sqlitePath)
+        return db
+
+    def __open(self, path):
+        self.logger.debug("__open(%r)", path)
+        connection = self.__connect(path)
+        backRefTables = []
+        for name, data in connection.execute("SELECT name, data FROM _guernsey"):
+            value = pickle.loads(str(data))
+            if name == "_database":
+                self.__dict__.update(value)
+            elif name == "_backRefTables":
+                backRefTables = value
+            else:
+                setattr(self, name, value)
+        for tableName in backRefTables:
+            getattr(self, tableName).setDatabase(self)
+
+    def enableJournal(self, filename):
+        self.logger.info("SQLite databases do not use a journal")
+
+    def sync(self):
+        self.__connection.commit()
+
+    def applyTransaction(self, batches):
+        Database.applyTransaction(self, batches)
+        self.__connection.commit()
+
+    def save(self, filename):
+        self.logger.debug("save(%r)", filename)
+        sqlitePath = self._computeSqliteFilename(filename)
+        if sqlitePath != self.__path:
+            self.logger.info("Moving database to %r", sqlitePath)
+            connection = self.__connect(sqlitePath)
+            for tableName, table in self._iterTables():
+                if isinstance(table, SqliteTable):
+                    table._moveTo(connection)
+
+        rows = []
+        other = {}
+        backRefTables = []
+        for k, v in self.__getstate__().iteritems():
+            if isinstance(v, Table):
+                table = copy.copy(v)
+                if table.getDatabase():
+                    backRefTables.append(k)
+                    table.setDatabase(None)
+                rows.append((k, buffer(pickle.dumps(table, pickle.HIGHEST_PROTOCOL))))
+            else:
+                other[k] = v
+        rows.append(("_backRefTables", buffer(pickle.dumps(backRefTables))))
+        rows.append(("_database", buffer(pickle.dumps(other, pickle.HIGHEST_PROTOCOL))))
+        try:
+            self.__connection.execute("DELETE FROM _guernsey")
+            self.__connection.executemany("INSERT INTO _guernsey (name, data) VALUES (?, ?)",
+                                          rows)
+            self.__connection.commit()
+            return True
+        except:
+            self.logger.exception("Could not save database")
+            self.__connection.rollback()
+            return False
+
+    def checkpointInThread(self, filename):
+        # The rows are in the file already, so the rest is saved right
+        # away in this thread
+        from twisted.internet import defer
+        return defer.maybeDeferred(self.checkpoint, filename)
+
+class DatabaseReader(object):
+    # Read-only copy of a database written by another process on the
+    # same host (the writer), which must have the journal enabled.
+    # refresh() applies the journal records the writer has synced
+    # since the last call, and reloads the database after each writer
+    # checkpoint. Records of LazyTable tables stay in the memory-mapped
+    # container file, and are shared by all processes. Changes made to
+    # the database of a reader are lost at the next reload.
+    logger = None
+
+    def __init__(self, databaseClass, filename):
+        if not self.__class__.logger:
+            self.__class__.logger = util.getLogger(self)
+        self.databaseClass = databaseClass
+        self.filename = filename
+        self.database = None
+        self.__generationFile = None
+        self.__checkpoints = None
+        self.__journal = None
+        self.refresh()
+
+    def __getGeneration(self):
+        if not self.__generationFile:
+            generationPath = self.databaseClass._computeGenerationFilename(self.filename)
+            if not os.path.exists(generationPath):
+                return None
+            self.__generationFile = GenerationFile(generationPath)
+        return self.__generationFile.read()
+
+    def refresh(self):
+        # Returns the current database, which is a new object after a
+        # reload
+        generation = self.__getGeneration()
+        if generation is None:
+            if self.database is None:
+                self.__reload()
+            return self.database
+        checkpoints, sequence = generation
+        if self.database is None or checkpoints != self.__checkpoints:
+            self.__reload()
+            self.__checkpoints = checkpoints
+        elif sequence > self.database._journalSequence:
+            if not self.__follow():
+                self.logger.info("Missed journal records, reloading database")
+                self.__reload()
+        return self.database
+
+    def __reload(self):
+        self.logger.debug("__reload()")
+        if self.__journal:
+            self.__journal.close()
+            self.__journal = None
+        self.database = self.databaseClass.load(self.filename)
+        self.__openJournal()
+        # Skip the records already replayed by load()
+        self.__follow()
+
+    def __openJournal(self):
+        try:
+            self.__journal = open(self.databaseClass._computeJournalFilename(self.filename), "rb")
+        except IOError:
+            self.__journal = None
+
+    def __isJournalRotated(self):
+        path = self.databaseClass._computeJournalFilename(self.filename)
+        try:
+            return os.stat(path).st_ino != os.fstat(self.__journal.fileno()).st_ino
+        except OSError:
+            return False
+
+    def __follow(self):
+        # Applies the new records of the journal. If the writer has
+        # rotated it, the rest of the old file is read before
+        # switching to the new one. Returns False if records are
+        # missing, e.g. because the journal was rotated twice.
+        if not self.__journal:
+            self.__openJournal()
+        while self.__journal:
+            for record in Journal.readRecordsFrom(self.__journal):
+                if record[0] > self.database._journalSequence + 1:
+                    return False
+                self.database._applyJournalRecord(*record)
+            if not self.__isJournalRotated():
+                break
+            self.__journal.close()
+            self.__openJournal()
+        return True
@@ -18,9 +18,12 @@
 #
 
 #
-# Common base class for data models
+# Common base classes for data models
 #
 
+import copy
+import gc
+
 import guernsey.util as util
 
 class Model(object):
@@ -38,6 +41,32 @@ class Model(object):
         if not self.__class__.logger:
             self.__class__.logger = util.getLogger(self)
 
+    @classmethod
+    def fromRecords(cls, records):
+        # Returns a list with one model per record dict, like calling
+        # the constructor for each, but without its per-instance
+        # overhead. Only for classes whose constructor does nothing
+        # but set the attributes of the record.
+        if not cls.logger:
+            cls.logger = util.getLogger(cls)
+        new = cls.__new__
+        models = []
+        append = models.append
+        # The garbage collector would otherwise run over and over while
+        # the new models pile up
+        gcEnabled = gc.isenabled()
+        gc.disable()
+        try:
+            for record in records:
+                model = new(cls)
+                if record:
+                    model.__dict__.update(record)
+                append(model)
+        finally:
+            if gcEnabled:
+                gc.enable()
+        return models
+
     def update(self, newModel):
         for key, value in newModel.__dict__.iteritems():
             setattr(self, key, value)
@@ -54,3 +83,105 @@ class Model(object):
 
     def __json__(self):
         return self.__dict__
+
+class SlottedModelType(type):
+    # Turns the fields class attribute of a SlottedModel subclass into
+    # __slots__, and collects the fields of all base classes
+    def __new__(cls, name, bases, attrs):
+        fields = tuple(attrs.get("fields", ()))
+        attrs["__slots__"] = fields
+        allFields = []
+        for base in bases:
+            allFields.extend(getattr(base, "_allFields", ()))
+        attrs["_allFields"] = tuple(allFields) + fields
+        return type.__new__(cls, name, bases, attrs)
+
+class SlottedModel(object):
+    # Compact alternative to Model for tables with many records. The
+    # attributes are declared in the fields class attribute and stored
+    # in slots instead of a per-instance dictionary. Declared fields
+    # that have not been set read as None.
+    __metaclass__ = SlottedModelType
+    logger = None
+    fields = ()
+
+    def __init__(self, record=None):
+        if not self.__class__.logger:
+            self.__class__.logger = util.getLogger(self)
+        if type(record) == dict:
+            for k, v in record.iteritems():
+                setattr(self, k, v)
+
+    @classmethod
+    def fromRecords(cls, records):
+        # See Model.fromRecords()
+        if not cls.logger:
+            cls.logger = util.getLogger(cls)
+        new = cls.__new__
+        models = []
+        gcEnabled = gc.isenabled()
+        gc.disable()
+        try:
+            for record in records:
+                model = new(cls)
+                if record:
+                    for k, v in record.iteritems():
+                        setattr(model, k, v)
+                models.append(model)
+        finally:
+            if gcEnabled:
+                gc.enable()
+        return models
+
+    def __getattr__(self, name):
+        if name in self._allFields:
+            return None
+        raise AttributeError("%r object has no attribute %r" % (self.__class__.__name__, name))
+
+    def _iterFields(self):
+        # Yields (name, value) for the fields that have been set
+        for k in self._allFields:
+            try:
+                yield k, object.__getattribute__(self, k)
+            except AttributeError:
+                pass
+
+    def __getstate__(self):
+        return dict(self._iterFields())
+
+    def __setstate__(self, state):
+        # Fields removed from the class since the state was saved are
+        # dropped
+        for k, v in state.iteritems():
+            if k in self._allFields:
+                setattr(self, k, v)
+        if not self.__class__.logger:
+            self.__class__.logger = util.getLogger(self)
+
+    def __copy__(self):
+        new = self.__class__.__new__(self.__class__)
+        for k, v in self._iterFields():
+            setattr(new, k, v)
+        return new
+
+    def __deepcopy__(self, memo):
+        new = self.__class__.__new__(self.__class__)
+        memo[id(self)] = new
+        for k, v in self._iterFields():
+            setattr(new, k, copy.deepcopy(v, memo))
+        return new
+
+    def update(self, newModel):
+        if isinstance(newModel, SlottedModel):
+            items = newModel._iterFields()
+        else:
+            items = newModel.__dict__.iteritems()
+        for key, value in items:
+            setattr(self, key, value)
+
+    def __repr__(self):
+        members = ["%s: %r" % (k, v) for k, v in self._iterFields()]
+        return self.__class__.__name__ + "{" + ", ".join(members) + "}"
+
+    def __json__(self):
+        return dict(self._iterFields())
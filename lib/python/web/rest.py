@@ -31,7 +31,7 @@ import guernsey.web.json as json
 import guernsey.web.model as gwm
 import guernsey.db as db
 
-import logging, os, sys
+import logging, os, sys, copy, datetime, time, collections
 
 class Resource(resource.Resource):
     #
@@ -44,6 +44,27 @@ class Resource(resource.Resource):
     logger = None
     contentTypeProducers = None
     templateSearchPath = None
+    # Logger for one access record per request (None = Off)
+    accessLogger = None
+    # Number of parsed Accept headers and content negotiation results
+    # to keep
+    acceptCacheSize = 256
+    # Media type preferred for Accept headers with media ranges, such
+    # as */* or text/*, if it has a producer and is in the range
+    defaultContentType = "text/html"
+    _acceptCache = collections.OrderedDict()
+    # Compiled templates are cached per file. Set checkTemplateChanges
+    # to False to never check the files for changes, e.g. in
+    # production.
+    cacheTemplates = True
+    checkTemplateChanges = True
+    _compiledTemplates = {}
+    templateExtensions = [".tmpl", ".inc"]
+    # Seconds to remember where in the search path a template file was
+    # found, or that it was not found (0 = Off). Forever if template
+    # changes are not checked.
+    templateLookupCacheTime = 10
+    _resolvedTemplates = {}
     _maxResourceDepth = 50
     _libraryPath = os.path.abspath(os.path.dirname(__file__))
     _libraryTemplatePath = os.path.join(_libraryPath, ".templates")
@@ -94,14 +115,27 @@ class Resource(resource.Resource):
         self.contentTypeProducers[contentType] = producer
 
     def removeContentTypeProducer(self, contentType):
-        if self.contentTypeProducer.get(contentType):
-            del self.contentTypeProducer[contentType]
+        if self.contentTypeProducers.get(contentType):
+            del self.contentTypeProducers[contentType]
 
     def _getDefaultTemplateFilename(self):
         return self.__class__.__name__ + ".tmpl"
 
     def _findTemplateInSearchPath(self, tmplRelPath):
         self.logger.debug("_findTemplateInSearchPath(%r)", tmplRelPath)
+        if not self.templateLookupCacheTime and self.checkTemplateChanges:
+            return self.__searchTemplate(tmplRelPath)
+        key = (tuple(self.templateSearchPath), tmplRelPath)
+        now = time.time()
+        cached = Resource._resolvedTemplates.get(key)
+        if cached and (not self.checkTemplateChanges
+                       or now - cached[0] < self.templateLookupCacheTime):
+            return cached[1]
+        templateFile = self.__searchTemplate(tmplRelPath)
+        Resource._resolvedTemplates[key] = (now, templateFile)
+        return templateFile
+
+    def __searchTemplate(self, tmplRelPath):
         for path in self.templateSearchPath:
             templateFile = os.path.join(path, tmplRelPath)
             self.logger.debug("Checking template file %r", templateFile)
@@ -109,6 +143,48 @@ class Resource(resource.Resource):
                 return templateFile
         return None
 
+    def _getTemplateClass(self, templateFile):
+        from Cheetah.Template import Template
+        if not self.cacheTemplates:
+            return Template.compile(file=templateFile)
+        mtime = None
+        if self.checkTemplateChanges:
+            mtime = os.path.getmtime(templateFile)
+        cached = Resource._compiledTemplates.get(templateFile)
+        if cached and (mtime is None or cached[0] == mtime):
+            return cached[1]
+        self.logger.debug("Compiling template file %r", templateFile)
+        templateClass = Template.compile(file=templateFile)
+        Resource._compiledTemplates[templateFile] = (mtime, templateClass)
+        return templateClass
+
+    def compileTemplates(self):
+        # Compiles all template files in the search path into the
+        # template cache, so that the first request of each page does
+        # not pay for it. Returns the number of compiled files.
+        self.logger.debug("compileTemplates()")
+        seen = set()
+        compiled = 0
+        for searchPath in self.templateSearchPath:
+            for dirPath, dirNames, fileNames in os.walk(searchPath):
+                dirNames.sort()
+                for fileName in sorted(fileNames):
+                    if os.path.splitext(fileName)[1] not in self.templateExtensions:
+                        continue
+                    templateFile = os.path.join(dirPath, fileName)
+                    realPath = os.path.realpath(templateFile)
+                    if realPath in seen:
+                        continue
+                    seen.add(realPath)
+                    try:
+                        self._getTemplateClass(templateFile)
+                        compiled += 1
+                    except Exception:
+                        self.logger.exception("Could not compile template file %r",
+                                              templateFile)
+        self.logger.info("Compiled %d template files", compiled)
+        return compiled
+
     def fillTemplate(self, model, templateFile=None, request=None):
         self.logger.debug("fillTemplate(%r, %r, %r)", model, templateFile, request)
 
@@ -135,7 +211,6 @@ class Resource(resource.Resource):
 
         if templateFile:
             self.logger.info("Using template file %r", templateFile)
-            from Cheetah.Template import Template
 
             def lookupTemplate(tmplRelPath):
                 self.logger.debug("lookupTemplate(%r)", tmplRelPath)
@@ -150,10 +225,10 @@ class Resource(resource.Resource):
                 return self.resolveUrl(str(request.URLPath()), url)
 
             self.logger.debug("Template model: %r", model)
-            template = Template(file=templateFile,
-                                searchList=[model, {"lookupTemplate": lookupTemplate,
-                                                    "resolveUrl": resolveUrl,
-                                                    "appName": self._appName}])
+            templateClass = self._getTemplateClass(templateFile)
+            template = templateClass(searchList=[model, {"lookupTemplate": lookupTemplate,
+                                                         "resolveUrl": resolveUrl,
+                                                         "appName": self._appName}])
             return str(template)
         else:
             if templateName:
@@ -196,50 +271,130 @@ class Resource(resource.Resource):
 
     def checkAccept(self, request, contentType, allowWildcard=False):
         self.logger.debug("checkAccept(%r, %r)", request, contentType)
-        acceptTypes = self.getAccepts(request)
-        
-        for quality, mediaType in acceptTypes:
-            if contentType == mediaType:
-                self.logger.debug("Accepts %r", contentType)
-                return True
-            if mediaType == "*/*" and allowWildcard:
-                self.logger.debug("Accepts %r (*/*)", contentType)
-                return True
+        accept = self.__getAcceptHeader(request)
+        acceptTypes, ranges = self.__getCachedAccept(("parse", accept),
+                                                     self._parseAccept, accept)
+        match = self._matchAccept(contentType.lower(), ranges)
+        if match and match[0] > 0 and (allowWildcard or match[1] == 2):
+            self.logger.debug("Accepts %r", contentType)
+            return True
         self.logger.debug("Does not accepts %r", contentType)
         return False
 
     def acceptsJson(self, request):
         return self.checkAccept(request, "application/json")
 
-    def getAccepts(self, request):
-        self.logger.debug("getAccepts(%r)", request)
-        accepts = request.getHeader("Accept").split(",")
-        self.logger.debug("Media Types accepted by client: %r", accepts)
-        
+    @staticmethod
+    def _matchesMediaRange(mediaType, mediaRange):
+        if mediaRange == "*/*":
+            return True
+        return mediaRange.endswith("/*") and mediaType.startswith(mediaRange[:-1])
+
+    @staticmethod
+    def _parseAccept(accept):
+        # Returns the (quality, mediaType) pairs of an Accept header
+        # with a quality above 0, best first, and a dict with the
+        # (quality, position) of every media type or range in it,
+        # including those refused with q=0
         acceptTypes = []
-        for accept in accepts:
-            mediaType, param = map(lambda x: x.strip(), accept.partition(";")[::2])
-            if param:
+        ranges = {}
+        for position, part in enumerate(accept.split(",")):
+            params = part.split(";")
+            mediaType = params[0].strip().lower()
+            if not mediaType:
+                continue
+            quality = 1.0
+            for param in params[1:]:
                 k, v = param.partition("=")[::2]
-                if k == "q":
-                    quality = float(v)
-            else:
-                quality = float(1)
-            acceptTypes.append((quality, mediaType))
-        return sorted(acceptTypes, key=lambda x: x[0], reverse=True)
+                if k.strip() == "q":
+                    try:
+                        quality = float(v)
+                    except ValueError:
+                        pass
+            ranges.setdefault(mediaType, (quality, position))
+            if quality > 0:
+                acceptTypes.append((quality, mediaType))
+        acceptTypes.sort(key=lambda x: x[0], reverse=True)
+        return acceptTypes, ranges
+
+    @staticmethod
+    def _matchAccept(mediaType, ranges):
+        # Returns (quality, specificity, -position) of the most specific
+        # entry of a parsed Accept header matching the media type: the
+        # type itself (specificity 2), type/* (1) or */* (0). None if
+        # there is no such entry.
+        keys = [mediaType, mediaType.partition("/")[0] + "/*", "*/*"]
+        for specificity, key in zip([2, 1, 0], keys):
+            if key in ranges:
+                quality, position = ranges[key]
+                return quality, specificity, -position
+        return None
+
+    def __getCachedAccept(self, key, compute, *args):
+        if self.acceptCacheSize <= 0:
+            return compute(*args)
+        cache = Resource._acceptCache
+        try:
+            value = cache.pop(key)
+        except KeyError:
+            value = compute(*args)
+            if len(cache) >= self.acceptCacheSize:
+                cache.popitem(last=False)
+        cache[key] = value
+        return value
+
+    def __getAcceptHeader(self, request):
+        # No Accept header means that anything is accepted
+        return request.getHeader("Accept") or "*/*"
+
+    def getAccepts(self, request):
+        self.logger.debug("getAccepts(%r)", request)
+        accept = self.__getAcceptHeader(request)
+        acceptTypes, ranges = self.__getCachedAccept(("parse", accept),
+                                                     self._parseAccept, accept)
+        self.logger.debug("Media Types accepted by client: %r", acceptTypes)
+        return list(acceptTypes)
+
+    def _negotiateContentType(self, accept):
+        # Returns (mediaType, producer key) for an Accept header, or
+        # None. Each producer type gets the quality of the most specific
+        # matching entry, so q=0 on a range refuses all types in it.
+        # Ties go to the more specific entry, then the one listed
+        # first, then defaultContentType, then alphabetical order.
+        acceptTypes, ranges = self.__getCachedAccept(("parse", accept),
+                                                     self._parseAccept, accept)
+        producers = self.contentTypeProducers
+        best = None
+        bestMatch = None
+        for candidate in [self.defaultContentType] + sorted(producers):
+            if candidate not in producers or "*" in candidate:
+                continue
+            match = self._matchAccept(candidate, ranges)
+            if match and match[0] > 0 and (bestMatch is None or match > bestMatch):
+                best, bestMatch = candidate, match
+        if best:
+            return best, best
+        # Producers registered for a range are only used if the
+        # resource has no producer for a type in it
+        for quality, mediaType in acceptTypes:
+            if "*" in mediaType and mediaType in producers and \
+               not any(self._matchesMediaRange(k, mediaType)
+                       for k in producers if "*" not in k):
+                return mediaType, mediaType
+        return None
 
     def performContentNegotiation(self, request):
         self.logger.debug("performContentNegotiation(%r)", request)
-        acceptTypes = self.getAccepts(request)
-        self.logger.debug("Media Types accepted by client (parsed): %r", acceptTypes)
-        
-        for quality, mediaType in acceptTypes:
-            self.logger.debug("Checking producer for media type: %r", mediaType)
-            producer = self.contentTypeProducers.get(mediaType)
-            if producer:
-                self.logger.debug("Found producer for mediaType: %r, %r", mediaType, producer)
-                request.setHeader("Content-Type", mediaType)
-                return producer(request)
+        accept = self.__getAcceptHeader(request)
+        producers = self.contentTypeProducers
+        # The result depends on the producer configuration too
+        key = ("negotiate", accept, self.defaultContentType, tuple(sorted(producers)))
+        result = self.__getCachedAccept(key, self._negotiateContentType, accept)
+        if result:
+            mediaType, producerKey = result
+            self.logger.debug("Found producer for mediaType: %r", mediaType)
+            request.setHeader("Content-Type", mediaType)
+            return producers[producerKey](request)
         self.notAcceptable(request)
         return " "
 
@@ -272,8 +427,14 @@ class Resource(resource.Resource):
     def checkAuth(self, request):
         return True, None
 
-    def render(self, request):
-        self.logger.info("render(%r)" % request)
+    def _logRequest(self, request):
+        # The levels are checked once, so that nothing is computed for
+        # a request unless it is logged
+        if not self.logger.isEnabledFor(logging.INFO):
+            return
+        self.logger.info("render(%r)", request)
+        if not self.logger.isEnabledFor(logging.DEBUG):
+            return
         self.logger.debug("request.method: %s", request.method)
         self.logger.debug("request.URLPath(): %s", request.URLPath())
         self.logger.debug("request.uri: %s", request.uri)
@@ -284,6 +445,27 @@ class Resource(resource.Resource):
         self.logger.debug("request.getHost(): %s", request.getHost())
         self.logger.debug("request.getRequestHostname(): %s", request.getRequestHostname())
 
+    def _logAccess(self, result, request, start):
+        # One structured record per finished (or aborted) request. The
+        # fields are also passed to handlers in the "access" attribute
+        # of the log record.
+        fields = {"time": datetime.datetime.utcnow().isoformat() + "Z",
+                  "method": request.method,
+                  "uri": request.uri,
+                  "status": request.code,
+                  "bytes": request.sentLength,
+                  "duration": round((time.time() - start) * 1000, 3),
+                  "client": request.getClientIP(),
+                  "userAgent": request.getHeader("User-Agent")}
+        if result is not None:
+            fields["aborted"] = True
+        self.accessLogger.info("%s", json.dumps(fields), extra={"access": fields})
+
+    def render(self, request):
+        self._logRequest(request)
+        if self.accessLogger:
+            request.notifyFinish().addBoth(self._logAccess, request, time.time())
+
         authenticated, response = self.checkAuth(request)
         if not authenticated:
             return response
@@ -416,9 +598,10 @@ class Resource(resource.Resource):
         request.setResponseCode(500)
 
     def redirectWithEndingSlash(self, request):
-        self.logger.debug("request.URLPath(): %s", request.URLPath())
-        self.logger.debug("request.uri: %s", request.uri)
-        self.logger.debug("request.path: %s", request.path)
+        if self.logger.isEnabledFor(logging.DEBUG):
+            self.logger.debug("request.URLPath(): %s", request.URLPath())
+            self.logger.debug("request.uri: %s", request.uri)
+            self.logger.debug("request.path: %s", request.path)
 
         path, queryParams = request.uri.partition("?")[::2]
         self.logger.debug("path: %s", path)
@@ -573,13 +756,20 @@ class DatabaseCollectionResource(DatabaseResource):
         else:
             return DatabaseResource.getChild(self, name, request)
 
-    def getEntityCollection(self, applyFilters=True, resultType=list):
+    def getEntityCollection(self, applyFilters=True, resultType=list, views=False):
+        # Each entity is copied when it is reached, or wrapped in a
+        # read-only view if views is set. With resultType None, the
+        # (filtered) iterator is returned as is, which raises
+        # db.TableChangedError if the table is modified while it is
+        # being used.
+        entities = self.getTable().iterstream(views=views)
         parent = self.getParent()
         if applyFilters and parent and hasattr(parent, "getFilter"):
             filterFunc = parent.getFilter()
-            return resultType(filterFunc(self.getTable().iteritems()))
-        else:
-            return resultType(self.getTable().iteritems())
+            entities = filterFunc(entities)
+        if resultType is None:
+            return entities
+        return resultType(entities)
 
 class DatabaseEntityResource(DatabaseResource):
     pass
@@ -595,6 +785,10 @@ class IssueModel(gwm.Model):
     callStack = None
     exception = None
     timestamp = None
+    # Repeated occurrences of an issue are counted instead of stored
+    fingerprint = None
+    count = 1
+    lastSeen = None
 
     def __init__(self, level, message, resourcePath=None, callStack=None, exception=None):
         gwm.Model.__init__(self)
@@ -604,15 +798,50 @@ class IssueModel(gwm.Model):
         self.callStack = callStack
         self.exception = exception
         self.timestamp = datetime.datetime.utcnow()
+        self.count = 1
+        self.lastSeen = self.timestamp
 
     def __json__(self):
         i = copy.deepcopy(self)
         if i:
             if i.timestamp:
                 i.timestamp = i.timestamp.strftime("%Y-%m-%d %H:%M:%S")
+            if i.lastSeen:
+                i.lastSeen = i.lastSeen.strftime("%Y-%m-%d %H:%M:%S")
         return i.__dict__
 
+class IssueIdIndex(db.SortedIndex):
+    # Issue ids are assigned in increasing order, so ordering by the
+    # numeric id is the same as ordering by time
+    def getValue(self, id, element):
+        return int(id)
+
 class IssueTable(db.Table):
+    tableIndexes = [IssueIdIndex("id")]
+
+    # Retention limits (None = unlimited), see setRetention()
+    maxCount = None
+    maxAge = None
+    maxBytes = None
+
+    # (last seen, id) pairs in the order the issues were last seen,
+    # the last seen time of the newest pair of each issue, and the
+    # size of each issue, only maintained when a limit is set
+    __retained = None
+    __lastSeen = None
+    __sizes = None
+    __totalBytes = 0
+
+    # Issue ids by fingerprint, built on first use
+    __fingerprints = None
+
+    _transientAttributes = db.Table._transientAttributes + ["maxCount", "maxAge", "maxBytes",
+                                                            "_IssueTable__retained",
+                                                            "_IssueTable__lastSeen",
+                                                            "_IssueTable__sizes",
+                                                            "_IssueTable__totalBytes",
+                                                            "_IssueTable__fingerprints"]
+
     def __init__(self):
         db.Table.__init__(self, "issues")
         self.maxId = 0
@@ -623,12 +852,163 @@ class IssueTable(db.Table):
         if not hasattr(self, "maxId"):
             self.maxId = 0
 
+    def setRetention(self, maxCount=None, maxAge=None, maxBytes=None):
+        # maxAge is in seconds, and maxBytes is the approximate total
+        # size of the text of all issues
+        self.logger.debug("setRetention(%r, %r, %r)", maxCount, maxAge, maxBytes)
+        self.maxCount = maxCount or None
+        self.maxAge = maxAge or None
+        self.maxBytes = maxBytes or None
+        if self.maxCount or self.maxAge or self.maxBytes:
+            self.__retained = collections.deque()
+            self.__lastSeen = {}
+            self.__sizes = {}
+            self.__totalBytes = 0
+            # Only the retention bookkeeping, the indexes are up to date
+            for issueId, issue in sorted(self.iteritems(getCopy=False),
+                                         key=lambda x: (self.__getLastSeen(x[1]), int(x[0]))):
+                self.__retain(issueId, issue)
+        else:
+            self.__retained = None
+            self.__lastSeen = None
+            self.__sizes = None
+            self.__totalBytes = 0
+        self.expire()
+
+    def getSize(self, issue):
+        size = 0
+        for value in issue.__dict__.itervalues():
+            if isinstance(value, basestring):
+                size += len(value)
+        return size
+
+    def getTotalBytes(self):
+        return self.__totalBytes
+
+    def _index(self, id, element):
+        db.Table._index(self, id, element)
+        if self.__fingerprints is not None and element is not None and element.fingerprint:
+            self.__fingerprints[element.fingerprint] = id
+        if self.__sizes is not None and element is not None:
+            self.__retain(id, element)
+
+    def __getLastSeen(self, issue):
+        return issue.lastSeen or issue.timestamp
+
+    def __retain(self, id, element):
+        # An issue seen again is queued again, and its earlier pair is
+        # skipped when it reaches the front
+        lastSeen = self.__getLastSeen(element)
+        if id not in self.__lastSeen or self.__lastSeen[id] != lastSeen:
+            self.__retained.append((lastSeen, id))
+            self.__lastSeen[id] = lastSeen
+        size = self.getSize(element)
+        self.__sizes[id] = size
+        self.__totalBytes += size
+
+    def _unindex(self, id, element):
+        db.Table._unindex(self, id, element)
+        if self.__fingerprints is not None and element is not None and \
+           self.__fingerprints.get(element.fingerprint) == id:
+            del self.__fingerprints[element.fingerprint]
+        if self.__sizes is not None and element is not None:
+            # The id stays in the retained queue, and is skipped when
+            # it reaches the front if the issue is gone
+            self.__totalBytes -= self.__sizes.pop(id, 0)
+
+    def expire(self):
+        # Removes the issues seen least recently until the table is
+        # within the retention limits. Each queued pair is only
+        # visited once.
+        if self.__retained is None:
+            return 0
+        oldest = None
+        if self.maxAge:
+            oldest = datetime.datetime.utcnow() - datetime.timedelta(seconds=self.maxAge)
+        removed = 0
+        while self.__retained:
+            lastSeen, issueId = self.__retained[0]
+            if self.__lastSeen.get(issueId) != lastSeen:
+                # Seen again later
+                self.__retained.popleft()
+                continue
+            if issueId not in self.__sizes:
+                # Already deleted
+                self.__retained.popleft()
+                del self.__lastSeen[issueId]
+                continue
+            if (self.maxCount and len(self.__sizes) > self.maxCount) or \
+               (self.maxBytes and self.__totalBytes > self.maxBytes) or \
+               (oldest and lastSeen is not None and lastSeen < oldest):
+                self.__retained.popleft()
+                del self.__lastSeen[issueId]
+                self.delete(issueId)
+                removed += 1
+            else:
+                break
+        if removed:
+            self.logger.debug("Removed %d old issues", removed)
+        return removed
+
+    def clear(self):
+        db.Table.clear(self)
+        if self.__fingerprints is not None:
+            self.__fingerprints.clear()
+        if self.__retained is not None:
+            self.__retained.clear()
+            self.__lastSeen.clear()
+            self.__sizes.clear()
+            self.__totalBytes = 0
+
+    def __getFingerprints(self):
+        if self.__fingerprints is None:
+            fingerprints = {}
+            for issueId, issue in self.iteritems(getCopy=False):
+                if issue.fingerprint:
+                    fingerprints[issue.fingerprint] = issueId
+            self.__fingerprints = fingerprints
+        return self.__fingerprints
+
+    def addOccurrence(self, fingerprint):
+        # Counts another occurrence of the issue with the given
+        # fingerprint. Returns the issue id, or None if there is no
+        # such issue.
+        issueId = self.__getFingerprints().get(fingerprint)
+        if issueId is None:
+            return None
+        issue = self.get(issueId, getCopy=False)
+        occurrence = gwm.Model()
+        occurrence.count = issue.count + 1
+        occurrence.lastSeen = datetime.datetime.utcnow()
+        self.update(issueId, occurrence)
+        return int(issueId)
+
     def add(self, model):
         issueId = self.maxId
         self.maxId += 1
         self.update(str(issueId), model, createIfNotFound=True)
+        self.expire()
         return issueId
 
+    def getNewest(self, limit=None, offset=0, before=None, getCopy=True):
+        # Returns (id, model) pairs, newest first. Use either offset,
+        # or before (an issue id) as a cursor for the next page.
+        high = None
+        if before is not None:
+            high = int(before) - 1
+        return self.findRange("id", high=high, reverse=True, limit=limit, offset=offset,
+                              getCopy=getCopy)
+
+    def _replayJournalRecord(self, op, args):
+        db.Table._replayJournalRecord(self, op, args)
+        if op == "applyBatch":
+            records = args[0]
+        else:
+            records = [(op, args)]
+        for op, args in records:
+            if op in ["set", "update"]:
+                self.maxId = max(self.maxId, int(args[0]) + 1)
+
 #
 # Database class
 #
@@ -647,6 +1027,13 @@ class Database(db.Database):
             self.logger.debug("No issue table found, adding to database")
             self.issues = IssueTable()
 
+class SqliteDatabase(db.SqliteDatabase):
+    # The issue table stays in memory and is pickled by save(), only
+    # SqliteTable tables of subclasses are stored as rows
+    def __init__(self):
+        db.SqliteDatabase.__init__(self)
+        self.issues = IssueTable()
+
 class TwistedLoggingObserver(twistedlog.PythonLoggingObserver):
     # This method is a modified version of
     # twisted.python.log.PythonLoggingObserver.emit()
@@ -668,6 +1055,12 @@ class RootResource(Resource):
     database = None
     databaseClass = Database
     appName = None
+    __databaseReader = None
+    # Count repeated issues from the same call site, instead of
+    # storing each one
+    aggregateIssues = True
+    # Compile all templates at startup (see Resource.compileTemplates())
+    precompileTemplates = False
 
     # Log handlers
     __memoryHandler = None
@@ -707,6 +1100,8 @@ class RootResource(Resource):
                                                  "Log Format String"))
 
             self.setupLogging()
+            if getattr(self.options, "accessLog", False):
+                self.setupAccessLog()
 
             self.__shutdownHooks = []
             reactor.addSystemEventTrigger("before", "shutdown",
@@ -731,6 +1126,7 @@ class RootResource(Resource):
 
             Resource.templatePath = self.options.templatePath
             Resource.disableLibraryTemplates = self.options.disableLibraryTemplates
+            Resource.checkTemplateChanges = not getattr(self.options, "staticTemplates", False)
             if self.appName:
                 Resource._appName = self.appName
             if hasattr(self.options, "corsAllowOrigins"):
@@ -762,8 +1158,18 @@ class RootResource(Resource):
             self.putChild("config", ConfigResource(self))
             self.putChild("issues", Issues(self))
 
-        if self.options.dbFile and os.path.exists(self.options.dbFile):
+            if self.precompileTemplates or getattr(self.options, "precompileTemplates", False):
+                self.compileTemplates()
+
+        if getattr(self.options, "dbCompression", None):
+            self.databaseClass.compression = self.options.dbCompression
+            self.databaseClass.compressionLevel = self.options.dbCompressionLevel
+        if self.options.dbFile and getattr(self.options, "dbReader", False):
+            self.__startDatabaseReader()
+        elif self.options.dbFile and self.databaseClass.exists(self.options.dbFile):
             self.logger.info("Loading database from file %s", self.options.dbFile)
+            if getattr(self.options, "dbLoadProcesses", 0):
+                self.databaseClass.loadProcesses = self.options.dbLoadProcesses
             self.database = self.databaseClass.load(self.options.dbFile)
             if not self.database.__class__ is self.databaseClass:
                 self.logger.warning("Database class is '%s.%s' instead of expected '%s.%s'",
@@ -781,21 +1187,68 @@ class RootResource(Resource):
             else:
                 self.database = self.databaseClass()
                 
-        if self.options.dbFile:
-            self.addShutdownHook(self._saveDatabase)
+        if not self.__databaseReader:
+            # Only the writer applies the retention limits
+            self.database.issues.setRetention(getattr(self.options, "issuesMaxCount", 0),
+                                              getattr(self.options, "issuesMaxAge", 0),
+                                              getattr(self.options, "issuesMaxSize", 0))
+
+        if self.options.dbFile and not self.__databaseReader:
+            from twisted.internet import task
+            if getattr(self.options, "dbJournal", False):
+                self.logger.info("Enabling database journal")
+                self.database.enableJournal(self.options.dbFile)
+                self.addShutdownHook(self.database.disableJournal)
+                if getattr(self.options, "dbCheckpointInterval", 0) > 0:
+                    self.logger.info("Scheduling database checkpoint every %s seconds",
+                                     self.options.dbCheckpointInterval)
+                    t = task.LoopingCall(self._checkpointDatabase)
+                    t.start(self.options.dbCheckpointInterval, now=False)
+            self.addShutdownHook(self._checkpointDatabase, allowBackground=False)
             if self.options.dbSaveInterval > 0:
                 self.logger.info("Scheduling database save procedure every %s seconds",
                                  self.options.dbSaveInterval)
-                from twisted.internet import task
                 t = task.LoopingCall(self._saveDatabase)
                 t.start(self.options.dbSaveInterval, now=False)
 
         if self.appName:
             self.addShutdownHook(self.logger.warning, "Stopping: %s", self.appName)
 
+    def __startDatabaseReader(self):
+        from twisted.internet import task
+        self.logger.info("Following database in file %s", self.options.dbFile)
+        self.__databaseReader = db.DatabaseReader(self.databaseClass, self.options.dbFile)
+        self.database = self.__databaseReader.database
+        interval = getattr(self.options, "dbRefreshInterval", 1)
+        if interval > 0:
+            t = task.LoopingCall(self._refreshDatabase)
+            t.start(interval, now=False)
+
+    def _refreshDatabase(self):
+        self.database = self.__databaseReader.refresh()
+
     def _saveDatabase(self):
-        self.logger.info("Saving database to file '%s'", self.options.dbFile) 
-        self.database.save(self.options.dbFile)
+        self.database.issues.expire()
+        if self.database.isJournalEnabled():
+            self.logger.debug("Syncing database journal")
+            self.database.sync()
+        else:
+            return self._checkpointDatabase()
+
+    def _checkpointDatabase(self, allowBackground=True):
+        if allowBackground and getattr(self.options, "dbBackgroundSave", False):
+            self.logger.info("Saving database to file '%s' in background", self.options.dbFile)
+            d = self.database.checkpointInThread(self.options.dbFile)
+
+            def eb(failure):
+                util.logTwistedFailure(self.logger, failure,
+                                       "Could not save database in background")
+
+            d.addErrback(eb)
+            return d
+        else:
+            self.logger.info("Saving database to file '%s'", self.options.dbFile)
+            self.database.checkpoint(self.options.dbFile)
 
     def getAppId(self):
         if self.options:
@@ -838,6 +1291,22 @@ class RootResource(Resource):
         rootLogger.addHandler(self.__streamHandler)
         rootLogger.setLevel(min(self._numericLogLevel, self._numericLogLevelConsole))
 
+    def setupAccessLog(self):
+        # Access records go to a file of their own, one JSON object per
+        # line, whatever the log levels are
+        import logging.handlers
+        accessLogger = logging.getLogger("guernsey.access")
+        accessLogger.propagate = False
+        accessLogger.setLevel(logging.INFO)
+        filePath = os.path.join(self.options.logDir, self.getAppId() + "-access.log")
+        handler = logging.handlers.RotatingFileHandler(filePath,
+                                                       maxBytes=self.options.logFileMaxSize,
+                                                       backupCount=self.options.logFileMaxBackups,
+                                                       delay=True)
+        handler.setFormatter(logging.Formatter("%(message)s"))
+        accessLogger.addHandler(handler)
+        Resource.accessLogger = accessLogger
+
     def resetLogging(self):
         self.logger.debug("resetLogging()")
         self._numericLogLevel = getattr(logging, self.config.get("logLevel").upper(), None)
@@ -893,7 +1362,26 @@ class RootResource(Resource):
     def getInstance(cls):
         return cls._instance
 
-    def createIssue(self, level, message, resource=None, saveCallStack=True, exception=None):
+    def getIssueFingerprint(self, level, message, fileName, lineNumber):
+        import hashlib
+        return hashlib.sha1(repr((level, message, fileName, lineNumber))).hexdigest()
+
+    def createIssue(self, level, message, resource=None, saveCallStack=True, exception=None,
+                    messageArgs=None):
+        # If messageArgs is given, message is a format string, and
+        # issues with different arguments are counted as the same issue
+        fingerprint = None
+        if self.aggregateIssues:
+            caller = sys._getframe(1)
+            fingerprint = self.getIssueFingerprint(level, message, caller.f_code.co_filename,
+                                                   caller.f_lineno)
+            issueId = self.database.issues.addOccurrence(fingerprint)
+            if issueId is not None:
+                return issueId
+
+        if messageArgs is not None:
+            message = message % messageArgs
+
         if resource:
             resourcePath = []
             while True:
@@ -923,7 +1411,8 @@ class RootResource(Resource):
             callStack = ""
 
         issue = IssueModel(level, message, resourcePath, callStack)
-        self.database.issues.add(issue)
+        issue.fingerprint = fingerprint
+        return self.database.issues.add(issue)
 
     def addConfigVariable(self, variable):
         self.config.addVariable(variable)
@@ -984,6 +1473,9 @@ class RootResource(Resource):
         parser.add_option("--log-file-max-backups", action="store", type="int",
                           dest="logFileMaxBackups", metavar="INTEGER",
                           help="Number of log file backups to keep (Default: %default)")
+        parser.add_option("--access-log", action="store_true", dest="accessLog",
+                          help="Write one JSON record per request to the access log file "
+                          "[APP_ID]-access.log in the log directory (Default: %default)")
         parser.add_option("--app-id", action="store", type="str",
                           dest="appId", metavar="IDENTIFIER",
                           help="Application identifier. Used e.g. for log file name. " \
@@ -1002,6 +1494,14 @@ class RootResource(Resource):
                           dest="disableLibraryTemplates",
                           help="Disable use of library-supplied template files "
                           "(Default: %default)")
+        parser.add_option("--static-templates", action="store_true",
+                          dest="staticTemplates",
+                          help="Compile each template file once and never check it for "
+                          "changes (Default: %default)")
+        parser.add_option("--precompile-templates", action="store_true",
+                          dest="precompileTemplates",
+                          help="Compile all template files in the template search path "
+                          "at startup (Default: %default)")
         parser.add_option("--cors-allow-origin", action="append", type="str",
                           dest="corsAllowOrigins", metavar="URL",
                           help="Allowed origin URL pattern for CORS requests. Multiple " \
@@ -1044,6 +1544,47 @@ class RootResource(Resource):
                           dest="dbSaveInterval", metavar="SECONDS",
                           help="Database save interval (0 = Off) "
                           "(Default: Off)")
+        parser.add_option("--issues-max-count", action="store", type="int",
+                          dest="issuesMaxCount", metavar="COUNT",
+                          help="Maximum number of issues to keep (0 = Unlimited) "
+                          "(Default: Unlimited)")
+        parser.add_option("--issues-max-age", action="store", type="int",
+                          dest="issuesMaxAge", metavar="SECONDS",
+                          help="Maximum age of issues to keep (0 = Unlimited) "
+                          "(Default: Unlimited)")
+        parser.add_option("--issues-max-size", action="store", type="str",
+                          dest="issuesMaxSize", metavar="SIZE",
+                          help="Maximum total size of issues to keep (Supports k/K/M postfixes) "
+                          "(0 = Unlimited) (Default: Unlimited)")
+        parser.add_option("--db-journal", action="store_true", dest="dbJournal",
+                          help="Append database changes to a journal, and only write full "
+                          "snapshots at checkpoints (Default: %default)")
+        parser.add_option("--db-checkpoint-interval", action="store", type="int",
+                          dest="dbCheckpointInterval", metavar="SECONDS",
+                          help="Database checkpoint interval when using a journal "
+                          "(0 = Only at shutdown) (Default: %default)")
+        parser.add_option("--db-background-save", action="store_true", dest="dbBackgroundSave",
+                          help="Save the database in a background thread, except at "
+                          "shutdown (Default: %default)")
+        parser.add_option("--db-load-processes", action="store", type="int",
+                          dest="dbLoadProcesses", metavar="COUNT",
+                          help="Number of processes decoding the tables of a JSON database "
+                          "in parallel at startup (0 = Off) (Default: Off)")
+        parser.add_option("--db-compression", action="store", type="choice",
+                          dest="dbCompression", metavar="CODEC",
+                          choices=sorted(db.Compression.codecs.keys()),
+                          help="Compress the saved database files with CODEC (zlib, gzip or bz2) "
+                          "(Default: Off)")
+        parser.add_option("--db-compression-level", action="store", type="int",
+                          dest="dbCompressionLevel", metavar="LEVEL",
+                          help="Database compression level (1-9) (Default: %default)")
+        parser.add_option("--db-reader", action="store_true", dest="dbReader",
+                          help="Only read the database, and follow the changes made by "
+                          "another process using --db-journal (Default: %default)")
+        parser.add_option("--db-refresh-interval", action="store", type="int",
+                          dest="dbRefreshInterval", metavar="SECONDS",
+                          help="How often a reader checks for database changes "
+                          "(Default: %default)")
         parser.add_option("--show-db", action="store_true", dest="showDb",
                           help="Just display the contents of the database (Default: %default)")
         parser.set_defaults(logLevelFile="WARNING")
@@ -1051,11 +1592,14 @@ class RootResource(Resource):
         parser.set_defaults(logDir="/tmp")
         parser.set_defaults(logFileMaxSize="10M")
         parser.set_defaults(logFileMaxBackups=5)
+        parser.set_defaults(accessLog=False)
         parser.set_defaults(appId=self.getAppId())
         parser.set_defaults(port=8080)
         parser.set_defaults(extraPorts=[])
         parser.set_defaults(templatePath="templates")
         parser.set_defaults(disableLibraryTemplates=False)
+        parser.set_defaults(staticTemplates=False)
+        parser.set_defaults(precompileTemplates=False)
         parser.set_defaults(corsAllowOrigins=[])
         parser.set_defaults(corsAllowMethods=[])
         parser.set_defaults(enableAcme=False)
@@ -1068,6 +1612,17 @@ class RootResource(Resource):
         parser.set_defaults(sslCertificate="keys/server.crt")
         parser.set_defaults(dbFile=None)
         parser.set_defaults(dbSaveInterval=0)
+        parser.set_defaults(issuesMaxCount=0)
+        parser.set_defaults(issuesMaxAge=0)
+        parser.set_defaults(issuesMaxSize="0")
+        parser.set_defaults(dbJournal=False)
+        parser.set_defaults(dbCheckpointInterval=3600)
+        parser.set_defaults(dbBackgroundSave=False)
+        parser.set_defaults(dbLoadProcesses=0)
+        parser.set_defaults(dbCompression=None)
+        parser.set_defaults(dbCompressionLevel=6)
+        parser.set_defaults(dbReader=False)
+        parser.set_defaults(dbRefreshInterval=1)
         parser.set_defaults(showDb=False)
 
         self.optparsePostInit(parser)
@@ -1089,18 +1644,27 @@ class RootResource(Resource):
         if options.user and not options.group or options.group and not options.user:
             parser.error("You need to specify both user and group, if specified at all")
 
-        if options.logFileMaxSize[-1] == "M":
-            size = int(options.logFileMaxSize[:-1]) * 1048576
-        elif options.logFileMaxSize[-1].upper() == "K":
-            size = int(options.logFileMaxSize[:-1] * 1024)
-        else:
-            size = int(options.logFileMaxSize)
-        options.logFileMaxSize = size
+        try:
+            options.logFileMaxSize = self._parseSize(options.logFileMaxSize)
+        except ValueError:
+            parser.error("Invalid log file size: %s" % options.logFileMaxSize)
+        try:
+            options.issuesMaxSize = self._parseSize(options.issuesMaxSize)
+        except ValueError:
+            parser.error("Invalid issues size: %s" % options.issuesMaxSize)
 
         self.optparsePostParse(parser, options, args)
 
         return options, args
 
+    def _parseSize(self, size):
+        if size[-1:].upper() == "M":
+            return int(size[:-1]) * 1048576
+        elif size[-1:].upper() == "K":
+            return int(size[:-1]) * 1024
+        else:
+            return int(size)
+
     def listen(self, site, ports, ignore=[]):
         import itertools
         listenPorts = map(lambda x: x[0], itertools.groupby(sorted(ports)))
@@ -1195,20 +1759,70 @@ class ConfigResource(Resource):
 #
 
 class Issues(DatabaseCollectionResource):
+    pageSize = 100
+
     def __init__(self, parent):
         DatabaseCollectionResource.__init__(self, Issue, "issues", parent)
 
-    def getHtml(self, request):
+    def _getPageArgs(self, request, defaultLimit=None):
+        args = self.cleanPostData(request)
+        try:
+            limit = defaultLimit
+            if "limit" in args:
+                limit = int(args["limit"])
+                if limit <= 0:
+                    return None
+            offset = max(0, int(args.get("offset", 0)))
+            before = args.get("before")
+            if before is not None:
+                before = int(before)
+        except (ValueError, TypeError):
+            # TypeError for arguments given more than once
+            return None
+        return limit, offset, before
+
+    def _getPage(self, request, limit, offset, before):
         issues = []
-        for issueId, issue in sorted(self.getTable().iteritems(),
-                                     key=lambda x: x[1].timestamp, reverse=True):
+        for issueId, issue in self.getTable().getNewest(limit, offset, before):
             issue.id = issueId
             issue.url = self.resolveUrl(str(request.URLPath()), str(issue.id))
             issues.append(issue)
-        return {"issues": issues}
+        return issues
+
+    def getHtml(self, request):
+        pageArgs = self._getPageArgs(request, self.pageSize)
+        if not pageArgs:
+            self.badRequest(request)
+            return "Invalid limit, offset or before argument\n"
+        limit, offset, before = pageArgs
+        issues = self._getPage(request, limit, offset, before)
+
+        newerUrl = None
+        olderUrl = None
+        if before is None and offset > 0:
+            newerUrl = "?offset=%d&limit=%d" % (max(0, offset - limit), limit)
+        elif before is not None:
+            # The page of issues right after this one, if any
+            low = before
+            if issues:
+                low = int(issues[0].id) + 1
+            newer = self.getTable().findRange("id", low=low, limit=limit + 1, getCopy=False)
+            if len(newer) > limit:
+                newerUrl = "?before=%d&limit=%d" % (int(newer[-2][0]) + 1, limit)
+            elif newer:
+                newerUrl = "?limit=%d" % limit
+        if len(issues) == limit:
+            olderUrl = "?before=%s&limit=%d" % (issues[-1].id, limit)
+        return {"issues": issues, "newerUrl": newerUrl, "olderUrl": olderUrl}
 
     def getJson(self, request):
-        return self.getTable().getAll()
+        if not request.args:
+            return self.getTable().getAll()
+        pageArgs = self._getPageArgs(request)
+        if not pageArgs:
+            self.badRequest(request)
+            return {"message": "Invalid limit, offset or before argument"}
+        return self._getPage(request, *pageArgs)
 
 class Issue(DatabaseEntityResource):
     def __init__(self, id, parent):